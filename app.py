@@ -1,17 +1,48 @@
 import os
+import signal
 import subprocess
 import socket
-from flask import Flask, render_template, request, jsonify
+import struct
+import threading
+import time
+import queue
+import uuid
+import asyncio
+import ipaddress
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from flask import Flask, Response, render_template, request, jsonify, has_request_context, g, send_file, send_from_directory
 from werkzeug.utils import secure_filename
-from urllib.parse import quote
+from werkzeug.http import http_date
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, Field, File, Data, Epilogue
+from urllib.parse import quote, urlencode
 import re
 import datetime
+import hashlib
+import hmac
+import multiprocessing
+import bisect
+import json
+import io
+import shlex
+import posixpath
+import mimetypes
+import cProfile
+from contextlib import contextmanager
+import zlib
+from chunkstore import Chunker, ChunkStore, ChunkStoreError, ChunkWriter, new_backup_id, restore_stream
 
 try:
     import nmap
 except ImportError:
     nmap = None
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 app = Flask(__name__)
 
 # --- CONFIGURATION ---
@@ -20,6 +51,57 @@ UPLOAD_FOLDER = 'uploads'
 PULLED_FILES_FOLDER = 'pulled_files'
 RECORDINGS_FOLDER = 'recordings'
 BACKUP_BASE_DRIVE = 'D:\\'
+# Talk to the adb server directly (smart-socket protocol) instead of forking `adb` per call.
+USE_ADB_SERVER = True
+ADB_SERVER_HOST = '127.0.0.1'
+ADB_SERVER_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+ADB_SERVER_MAX_CONNECTIONS = 16
+BATTERY_INFO_TTL = 15 # seconds; model/serial/CPU/RAM are cached until the device reconnects
+PACKAGE_CATALOG_VERIFY = 30 # seconds an app catalog is served as-is before a cheap fingerprint check against the device
+JOB_WORKERS = 4 # long-running operations (backup, photo download, installs) run in this pool
+JOB_HISTORY = 200 # finished jobs kept around for /jobs queries
+PHOTO_SYNC_WORKERS = 4 # concurrent `adb pull` transfers during a photo sync
+PHOTO_SYNC_HASH = False # when only a file's mtime changed, compare md5 sums before re-pulling it
+STREAMING_UPLOADS = True # pipe push_file/install_apk uploads straight to the device instead of saving them first
+UPLOAD_CHUNK_SIZE = 256 * 1024
+FANOUT_WORKERS = 16 # devices handled at once when a request targets several serials (or "all")
+FANOUT_TIMEOUT = 120 # seconds each device gets before it is reported as timed out
+SHELL_STREAM_BUFFER = 2000 # output lines each live shell stream keeps for late subscribers
+SHELL_STREAM_BACKPRESSURE = 10 # seconds the reader waits for a lagging subscriber before dropping old lines
+SHELL_STREAM_IDLE = 300 # seconds an unwatched or finished stream is kept before it is reaped
+TELEMETRY_INTERVAL = 5 # seconds between telemetry samples for each device while the sampler runs
+TELEMETRY_CAPACITY = 4320 # samples kept per series (6 hours at the default interval, 16 bytes each)
+TELEMETRY_TOP_PROCESSES = 10 # processes whose RSS is recorded on each sample, largest first
+TELEMETRY_MAX_PROCESSES = 48 # per-device process series kept before the least recently seen is evicted
+SCAN_PORTS = [5555, 80, 443, 8080] # TCP ports probed per host; a refused connection still proves the host is up
+SCAN_TIMEOUT = 1.0 # seconds per connection attempt (Windows retries a refused SYN for ~1 s)
+SCAN_CONCURRENCY = 512 # connection attempts in flight at once
+SCAN_MAX_HOSTS = 1024 # largest network a single scan accepts
+SCAN_CACHE_TTL = 120 # seconds a live host is served from cache before it is probed again
+SCAN_DOWN_TTL = 30 # same for addresses that did not answer
+SCREENSHOT_THUMB_SIZE = 320 # longest edge of cached thumbnails (needs Pillow)
+SCREENSHOT_THUMB_CACHE = 64 # recent captures whose thumbnails stay in memory
+SCREENSHOT_BURST_MAX_FRAMES = 600
+SCREENSHOT_BURST_INFLIGHT = 2 # captures allowed to overlap during a burst (the device PNG-encodes in parallel)
+METRICS_SLOW_COMMAND = 2.0 # seconds; adb commands slower than this are kept in the slow-command log
+METRICS_SLOW_LOG = 200 # slow commands remembered for /metrics/slow
+PROFILE_REQUESTS = False # cProfile every authorized request; a single request opts in with an X-Profile: 1 header
+PROFILES_FOLDER = 'profiles' # where the .prof dumps go (open them with snakeviz or pstats)
+SCRCPY_CPU_BUDGET = max((os.cpu_count() or 2) - 1, 1) # cost units all scrcpy sessions may use together (a full-quality stream is 1)
+SCRCPY_SESSION_HISTORY = 50 # ended mirror/recording sessions kept for /sessions
+SCRCPY_STOP_TIMEOUT = 10 # seconds scrcpy gets to finalize a recording before it is killed
+FILE_LIST_TTL = 5 # seconds a device directory listing is served from cache
+FILE_LIST_CACHE = 256 # directory listings kept across all devices
+FILE_STREAM_TIMEOUT = 60 # seconds a streamed download may stall waiting for the device
+MEDIA_LINK_TTL = 3600 # seconds a signed file or backup download link works (long enough to keep seeking in a video)
+BACKUP_STORE = True # keep backups as deduplicated, compressed chunks (a repeat backup only stores what changed); False writes plain .ab files
+BACKUP_WORKERS = max(min(os.cpu_count() or 2, 5) - 1, 1) # processes that find chunk boundaries and compress new chunks
+BACKUP_COMPRESS_LEVEL = 6 # zlib level for stored chunks and for the payload of rebuilt .ab files
+BACKUP_MIN_CHUNK = 16 * 1024
+BACKUP_MAX_CHUNK = 256 * 1024 # chunks average about 80 KiB between these bounds
+BACKUP_SEGMENT_SIZE = 4 * 1024 * 1024 # stream bytes handed to a worker at once (also the compression batch size)
+BACKUP_READ_AHEAD = 64 * 1024 * 1024 # device data buffered while the workers catch up, so the transfer never waits on them
+BACKUP_STALL_TIMEOUT = 600 # seconds the device may send nothing (it waits for the on-screen confirmation first)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['PULLED_FILES_FOLDER'] = PULLED_FILES_FOLDER
 app.config['RECORDINGS_FOLDER'] = RECORDINGS_FOLDER
@@ -31,59 +113,2397 @@ os.makedirs(RECORDINGS_FOLDER, exist_ok=True)
 os.makedirs(os.path.join(BACKUP_BASE_DRIVE, 'NexusPanel_Backups'), exist_ok=True)
 os.makedirs(os.path.join(BACKUP_BASE_DRIVE, 'NexusPanel_Photos'), exist_ok=True)
 
-active_process = None
+# --- ADB Server Client ---
+# The adb server closes a socket once the requested service finishes, so there is nothing to
+# keep alive between calls: what we reuse is the long-lived server itself, and each call costs a
+# loopback connect instead of a fork/exec of the adb client. The semaphore bounds concurrency.
+class AdbServerError(Exception):
+    pass
+
+class AdbServerClient:
+    SHELL_STDOUT, SHELL_STDERR, SHELL_EXIT = 1, 2, 3
+
+    def __init__(self, host, port, max_connections):
+        self.host = host
+        self.port = port
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._features = {} # serial -> feature set the device reported, until it reconnects
+
+    def _connect(self, timeout):
+        sock = socket.create_connection((self.host, self.port), timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    @staticmethod
+    def _recv_exact(sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk: raise AdbServerError("Connection closed by adb server.")
+            data += chunk
+        return data
+
+    def _request(self, sock, service):
+        payload = service.encode('utf-8')
+        sock.sendall(b'%04x' % len(payload) + payload)
+        status = self._recv_exact(sock, 4)
+        if status == b'OKAY': return
+        if status == b'FAIL':
+            length = int(self._recv_exact(sock, 4), 16)
+            raise AdbServerError(self._recv_exact(sock, length).decode('utf-8', 'ignore'))
+        raise AdbServerError(f"Unexpected adb server reply: {status!r}")
+
+    def _read_length_prefixed(self, sock):
+        length = int(self._recv_exact(sock, 4), 16)
+        return self._recv_exact(sock, length).decode('utf-8', 'ignore')
+
+    def devices(self, timeout=30):
+        with self._slots, self.open_host_service('host:devices', timeout) as sock:
+            return self._read_length_prefixed(sock)
+
+    def features(self, serial, timeout=30):
+        features = self._features.get(serial)
+        if features is None:
+            service = f'host-serial:{serial}:features' if serial else 'host:features'
+            with self._slots, self.open_host_service(service, timeout) as sock:
+                features = frozenset(self._read_length_prefixed(sock).split(','))
+            if serial: self._features[serial] = features
+        return features
+
+    def forget(self, serial):
+        self._features.pop(serial, None)
+
+    def open_host_service(self, service, timeout=30):
+        sock = self._connect(timeout)
+        try:
+            self._request(sock, service)
+            return sock
+        except Exception:
+            sock.close()
+            raise
+
+    def open_service(self, serial, service, timeout=30):
+        sock = self._connect(timeout)
+        try:
+            self._request(sock, f'host:transport:{serial}' if serial else 'host:transport-any')
+            self._request(sock, service)
+            return sock
+        except Exception:
+            sock.close()
+            raise
+
+    def shell(self, serial, command, timeout=30):
+        # shell,v2 frames stdout/stderr/exit as [id:1][len:4 LE][data], which gives us the exit code.
+        deadline = time.monotonic() + timeout
+        stdout, stderr, exit_code = [], [], None
+        with self._slots:
+            sock = self.open_service(serial, f'shell,v2,raw:{command}', timeout)
+            with sock:
+                while exit_code is None:
+                    sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                    try:
+                        header = self._recv_exact(sock, 5)
+                    except socket.timeout:
+                        raise subprocess.TimeoutExpired(command, timeout)
+                    except AdbServerError:
+                        break
+                    packet_id, length = struct.unpack('<BI', header)
+                    data = self._recv_exact(sock, length) if length else b''
+                    if packet_id == self.SHELL_STDOUT: stdout.append(data)
+                    elif packet_id == self.SHELL_STDERR: stderr.append(data)
+                    elif packet_id == self.SHELL_EXIT: exit_code = data[0] if data else 0
+        output = b''.join(stdout) + b''.join(stderr)
+        return exit_code == 0, output.decode('utf-8', 'ignore').strip()
+
+    def run(self, args, timeout=30):
+        # Returns None for anything this client does not speak, so the caller can fall back to the CLI.
+        serial = None
+        if args[:1] == ['-s'] and len(args) > 2: serial, args = args[1], args[2:]
+        if not args or args[0].startswith('-'): return None
+        try:
+            if args == ['devices']:
+                return True, ("List of devices attached\n" + self.devices(timeout)).strip()
+            # Old devices without the shell_v2 feature cannot report exit codes; the CLI handles them.
+            if args[0] == 'shell' and len(args) > 1 and 'shell_v2' in self.features(serial, timeout):
+                return self.shell(serial, ' '.join(args[1:]), timeout)
+        except AdbServerError as e:
+            message = str(e)
+            if 'device' in message or 'no devices' in message: return False, f"error: {message}"
+            # Anything else (e.g. the server dropping the connection) failed before the command started.
+            return None
+        except OSError:
+            return None
+        return None
+
+adb_server = AdbServerClient(ADB_SERVER_HOST, ADB_SERVER_PORT, ADB_SERVER_MAX_CONNECTIONS)
+
+# --- Device Registry ---
+# Fed by the adb server's host:track-devices-l stream, which pushes the full device list on every
+# change. Routes read it in O(1); while the stream is down they fall back to polling `adb devices`.
+class DeviceRegistry:
+    def __init__(self, client):
+        self.client = client
+        self.tracking = False
+        self._devices = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._track_loop, name='device-registry', daemon=True)
+            self._thread.start()
+
+    def on_change(self, callback):
+        # callback(serial, old, new); old/new are device dicts, or None when added/removed.
+        self._listeners.append(callback)
+
+    def get(self, serial):
+        return self._devices.get(serial)
+
+    def snapshot(self):
+        return list(self._devices.values())
+
+    def pick(self, serial=None):
+        if serial:
+            device = self._devices.get(serial)
+            return serial if device and device['state'] == 'device' else None
+        for device in self._devices.values():
+            if device['state'] == 'device': return device['serial']
+        return None
+
+    def _track_loop(self):
+        backoff = 1
+        while True:
+            try:
+                with self.client.open_host_service('host:track-devices-l') as sock:
+                    sock.settimeout(None)
+                    backoff = 1
+                    while True:
+                        self._apply(self.client._read_length_prefixed(sock))
+                        self.tracking = True
+            except (OSError, AdbServerError):
+                pass
+            self.tracking = False
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    @staticmethod
+    def parse(payload):
+        devices = {}
+        for line in payload.splitlines():
+            parts = line.split()
+            if len(parts) < 2: continue
+            device = {"serial": parts[0], "state": None, "model": None, "product": None, "device": None, "transport_id": None}
+            state = []
+            for part in parts[1:]:
+                key, sep, value = part.partition(':')
+                if sep and key in ("model", "product", "device", "transport_id", "usb"): device[key] = value
+                else: state.append(part)
+            device['state'] = ' '.join(state)
+            device['transport'] = 'tcp' if ':' in device['serial'] else 'usb'
+            devices[device['serial']] = device
+        return devices
+
+    def _apply(self, payload):
+        devices = self.parse(payload)
+        with self._lock:
+            previous, self._devices = self._devices, devices
+        for serial in previous.keys() | devices.keys():
+            old, new = previous.get(serial), devices.get(serial)
+            if old == new: continue
+            for callback in list(self._listeners):
+                try: callback(serial, old, new)
+                except Exception as e: print(f"Device registry listener failed: {e}")
+
+device_registry = DeviceRegistry(adb_server)
+
+# --- Metrics ---
+# Every run_command/Job.run call is timed per adb subcommand and tagged with the route (or job kind)
+# and device behind it, and so are exec: transfers, live shell streams and scrcpy sessions, from
+# start until they end; requests are timed per route. Recording is one lock and a few dict updates,
+# and /metrics renders it all in Prometheus text format.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class Histogram:
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        self.total += seconds
+
+def command_labels(command):
+    # ("shell", "SERIAL") for ["adb", "-s", "SERIAL", "shell", ...]; other programs are named by their
+    # executable, with the device taken from --serial (scrcpy).
+    if command[:1] != ["adb"]:
+        device = command[command.index('--serial') + 1] if '--serial' in command[:-1] else ''
+        return (os.path.basename(str(command[0])) if command else ''), device
+    args, device = command[1:], ''
+    if args[:1] == ['-s'] and len(args) > 1: device, args = args[1], args[2:]
+    return (args[0] if args else ''), device
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metric_line(name, labels, value):
+    rendered = ','.join(f'{key}="{label_value(label)}"' for key, label in labels.items())
+    return f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}"
+
+class CommandTimer:
+    def __init__(self, registry, command, transport, slow=True):
+        self.registry = registry
+        self.command = command
+        self.transport = transport
+        self.slow = slow # False for open-ended streams and sessions, which stay out of the slow log
+        self.outcome = None
+        self.ended = False
+
+    def __enter__(self):
+        self.route = self.registry.current_route()
+        self.registry._begin(self.transport)
+        self.started = time.perf_counter()
+        return self
+
+    def via(self, transport):
+        # The adb server declined the command and it falls back to a subprocess.
+        self.registry._move(self.transport, transport)
+        self.transport = transport
+
+    def finish(self, success, output, timed_out=False):
+        self.outcome = 'timeout' if timed_out else ('ok' if success else 'failed')
+        return success, output
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close('cancelled' if exc_type is JobCancelled else 'failed')
+
+    def close(self, outcome='failed'):
+        # `outcome` applies unless finish() already set one; only the first close is recorded.
+        if self.outcome is None: self.outcome = outcome
+        self.registry._end(self, time.perf_counter() - self.started)
+
+class Metrics:
+    def __init__(self, slow_threshold, slow_log):
+        self.slow_threshold = slow_threshold
+        self.started = time.time()
+        self._slow = deque(maxlen=slow_log)
+        self._slow_total = 0
+        self._commands = {} # (command, route, device, transport) -> Histogram
+        self._errors = {} # (command, route, device, reason) -> count
+        self._requests = {} # (route, method, status) -> Histogram
+        self._in_flight = {'server': 0, 'cli': 0}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def current_route(self):
+        route = getattr(self._local, 'route', None)
+        if route: return route
+        if has_request_context(): return request.url_rule.rule if request.url_rule else 'unmatched'
+        return 'background'
+
+    @contextmanager
+    def tagged(self, route):
+        # Work handed to another thread (fan-out, jobs) keeps the label of whatever started it.
+        previous = getattr(self._local, 'route', None)
+        self._local.route = route
+        try: yield
+        finally: self._local.route = previous
+
+    def command(self, command, transport='cli'):
+        return CommandTimer(self, command, transport)
+
+    def start(self, command, transport='cli', slow=True):
+        # For a child or stream that outlives the block that started it; the owner calls close() when it ends.
+        return CommandTimer(self, command, transport, slow).__enter__()
+
+    def _begin(self, transport):
+        with self._lock: self._in_flight[transport] += 1
+
+    def _move(self, old, new):
+        with self._lock:
+            self._in_flight[old] -= 1
+            self._in_flight[new] += 1
+
+    def _end(self, call, seconds):
+        name, device = command_labels(call.command)
+        with self._lock:
+            if call.ended: return
+            call.ended = True
+            self._in_flight[call.transport] -= 1
+            histogram = self._commands.get((name, call.route, device, call.transport))
+            if histogram is None: histogram = self._commands[(name, call.route, device, call.transport)] = Histogram()
+            histogram.observe(seconds)
+            if call.outcome != 'ok':
+                key = (name, call.route, device, call.outcome)
+                self._errors[key] = self._errors.get(key, 0) + 1
+            if call.slow and seconds >= self.slow_threshold:
+                self._slow_total += 1
+                self._slow.append({
+                    "time": time.time(), "seconds": round(seconds, 3), "command": ' '.join(map(str, call.command))[:500],
+                    "route": call.route, "device": device, "transport": call.transport, "outcome": call.outcome,
+                })
+
+    def observe_request(self, route, method, status, seconds):
+        with self._lock:
+            histogram = self._requests.get((route, method, status))
+            if histogram is None: histogram = self._requests[(route, method, status)] = Histogram()
+            histogram.observe(seconds)
+
+    def slow_commands(self):
+        with self._lock: return list(reversed(self._slow))
+
+    def render(self):
+        with self._lock:
+            commands = [(key, list(h.counts), h.total) for key, h in self._commands.items()]
+            requests = [(key, list(h.counts), h.total) for key, h in self._requests.items()]
+            errors, in_flight, slow_total = dict(self._errors), dict(self._in_flight), self._slow_total
+        lines = []
+
+        def histogram(name, help_text, label_names, series):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} histogram"])
+            for key, counts, total in sorted(series):
+                labels = dict(zip(label_names, key))
+                cumulative = 0
+                for bound, count in zip(METRICS_BUCKETS + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(metric_line(f"{name}_bucket", {**labels, "le": bound}, cumulative))
+                lines.append(metric_line(f"{name}_sum", labels, round(total, 6)))
+                lines.append(metric_line(f"{name}_count", labels, cumulative))
+
+        histogram("nexus_adb_command_seconds", "Time spent per adb subcommand.", ("command", "route", "device", "transport"), commands)
+        lines.extend(["# HELP nexus_adb_command_errors_total adb commands that failed, timed out or were cancelled.", "# TYPE nexus_adb_command_errors_total counter"])
+        for key, count in sorted(errors.items()):
+            lines.append(metric_line("nexus_adb_command_errors_total", dict(zip(("command", "route", "device", "reason"), key)), count))
+        lines.extend(["# HELP nexus_adb_commands_in_flight adb commands, transfers, shell streams and scrcpy sessions running now; transport=cli ones are child processes.", "# TYPE nexus_adb_commands_in_flight gauge"])
+        for transport, count in sorted(in_flight.items()):
+            lines.append(metric_line("nexus_adb_commands_in_flight", {"transport": transport}, count))
+        lines.extend([f"# HELP nexus_adb_slow_commands_total adb commands slower than {self.slow_threshold:g} seconds.", "# TYPE nexus_adb_slow_commands_total counter"])
+        lines.append(metric_line("nexus_adb_slow_commands_total", {}, slow_total))
+        histogram("nexus_http_request_seconds", "Request latency per route, up to the start of the response body.", ("route", "method", "status"), requests)
+        lines.extend(["# HELP nexus_process_start_time_seconds When the panel started.", "# TYPE nexus_process_start_time_seconds gauge"])
+        lines.append(metric_line("nexus_process_start_time_seconds", {}, round(self.started, 3)))
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(METRICS_SLOW_COMMAND, METRICS_SLOW_LOG)
+
+def start_profiler():
+    profiler = cProfile.Profile()
+    try: profiler.enable()
+    except ValueError: return None # another request is already being profiled (one profiler at a time on 3.12+)
+    return profiler
+
+@app.before_request
+def begin_request_metrics():
+    g.request_started = time.perf_counter()
+    g.profiler = None
+    if (PROFILE_REQUESTS or request.headers.get('X-Profile') == '1') and is_authorized(request): g.profiler = start_profiler()
+
+@app.after_request
+def record_request_metrics(response):
+    profiler = g.get('profiler')
+    if profiler:
+        profiler.disable()
+        os.makedirs(PROFILES_FOLDER, exist_ok=True)
+        name = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{request.endpoint or 'unmatched'}.prof"
+        profiler.dump_stats(os.path.join(PROFILES_FOLDER, name))
+        response.headers['X-Profile-File'] = name
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - started)
+    return response
 
 # --- Helper Functions ---
 def is_authorized(req):
     return req.headers.get("X-Api-Key") == API_SECRET_KEY
 
+def hidden_startupinfo():
+    startupinfo = None
+    if os.name == 'nt':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    return startupinfo
+
+def terminate_process(process, kill=False):
+    # Long-running children are started in their own session so the whole tree goes down with them.
+    if process.poll() is not None: return
+    if os.name != 'nt':
+        try: return os.killpg(process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+        except OSError: pass
+    if kill: process.kill()
+    else: process.terminate()
+
 def run_command(command, timeout=30):
-    try:
-        startupinfo = None
-        if os.name == 'nt':
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        process = subprocess.run(
-            command, capture_output=True, text=True, timeout=timeout, check=False, startupinfo=startupinfo, encoding='utf-8', errors='ignore'
-        )
-        output = (process.stdout or "") + (process.stderr or "")
-        return process.returncode == 0, output.strip()
-    except Exception as e: return False, f"An unexpected error occurred: {e}"
+    use_server = USE_ADB_SERVER and command[:1] == ["adb"]
+    with metrics.command(command, 'server' if use_server else 'cli') as call:
+        if use_server:
+            try:
+                result = adb_server.run(command[1:], timeout)
+            except subprocess.TimeoutExpired as e: return call.finish(False, f"An unexpected error occurred: {e}", timed_out=True)
+            except Exception as e: return call.finish(False, f"An unexpected error occurred: {e}")
+            if result is not None: return call.finish(*result)
+            call.via('cli')
+        try:
+            process = subprocess.run(
+                command, capture_output=True, text=True, timeout=timeout, check=False, startupinfo=hidden_startupinfo(), encoding='utf-8', errors='ignore'
+            )
+            output = (process.stdout or "") + (process.stderr or "")
+            return call.finish(process.returncode == 0, output.strip())
+        except subprocess.TimeoutExpired as e: return call.finish(False, f"An unexpected error occurred: {e}", timed_out=True)
+        except Exception as e: return call.finish(False, f"An unexpected error occurred: {e}")
 
 def get_connected_device():
+    # Clients pick a device with the X-Device-Serial header (?serial= on media links); without it the first ready device wins.
+    wanted = (request.headers.get("X-Device-Serial") or request.args.get('serial')) if has_request_context() else None
+    if USE_ADB_SERVER:
+        device_registry.start()
+        if device_registry.tracking: return device_registry.pick(wanted)
     success, output = run_command(["adb", "devices"])
     if not success: return None
     lines = output.strip().split('\n')[1:]
     for line in lines:
-        if '\tdevice' in line: return line.split('\t')[0]
+        if '\tdevice' in line and (not wanted or line.split('\t')[0] == wanted): return line.split('\t')[0]
     return None
 
+# --- Background Jobs ---
+# Long operations run in a bounded pool and return a job id immediately. Jobs for the same device
+# run one after another (adb serializes them on the device anyway); other devices are unaffected.
+JOB_OUTPUT_LIMIT = 64 * 1024
+JOB_PROGRESS_INTERVAL = 1 # seconds between progress samples while a transfer runs
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, kind, device_id, description):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.device_id = device_id
+        self.description = description
+        self.status = 'queued'
+        self.progress = None
+        self.message = ''
+        self.result = None
+        self.created = time.time()
+        self.started = self.finished = None
+        self._cancel = threading.Event()
+        self._processes = set() # children of Job.run, which may be called from several threads at once
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.status in ('succeeded', 'failed', 'cancelled')
+
+    def to_dict(self):
+        return {
+            "id": self.id, "kind": self.kind, "device": self.device_id, "description": self.description,
+            "status": self.status, "progress": self.progress, "message": self.message, "result": self.result,
+            "created": self.created, "started": self.started, "finished": self.finished,
+        }
+
+    def cancel(self):
+        self._cancel.set()
+        with self._lock: processes = list(self._processes)
+        for process in processes: terminate_process(process)
+
+    def check_cancelled(self):
+        if self._cancel.is_set(): raise JobCancelled()
+
+    def sleep(self, seconds):
+        # Like time.sleep, but ends with JobCancelled as soon as the job is cancelled.
+        if self._cancel.wait(seconds): raise JobCancelled()
+
+    def run(self, command, timeout, progress=None):
+        # Like run_command, but cancellable. adb only prints its "[ 42%]" lines to a terminal, so
+        # progress comes from `progress()` (a percentage, or None), sampled while the command runs.
+        self.check_cancelled()
+        with metrics.command(command) as call:
+            try:
+                process = subprocess.Popen(
+                    command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, startupinfo=hidden_startupinfo(), start_new_session=os.name != 'nt'
+                )
+            except Exception as e: return call.finish(False, f"An unexpected error occurred: {e}")
+            with self._lock: self._processes.add(process)
+            if self._cancel.is_set(): terminate_process(process) # cancel() ran before the child was registered
+            timed_out, finished = threading.Event(), threading.Event()
+            watchdog = threading.Timer(timeout, lambda: (timed_out.set(), terminate_process(process, kill=True)))
+            watchdog.start()
+            if progress: threading.Thread(target=self._sample, args=(progress, finished), daemon=True).start()
+            output = bytearray()
+            try:
+                for chunk in iter(lambda: process.stdout.read1(4096), b''):
+                    output += chunk
+                    del output[:-JOB_OUTPUT_LIMIT]
+                process.wait()
+            finally:
+                finished.set()
+                watchdog.cancel()
+                with self._lock: self._processes.discard(process)
+            self.check_cancelled()
+            if timed_out.is_set(): return call.finish(False, f"Command timed out after {timeout} seconds.", timed_out=True)
+            return call.finish(process.returncode == 0, output.decode('utf-8', 'ignore').strip())
+
+    def _sample(self, progress, finished):
+        while not finished.wait(JOB_PROGRESS_INTERVAL):
+            try: percent = progress()
+            except OSError: continue
+            if percent is not None: self.progress = max(min(int(percent), 99), self.progress or 0)
+
+def local_progress(path, total):
+    # For Job.run: bytes that have arrived at `path` (a file, or a folder counted recursively).
+    def sample():
+        if os.path.isfile(path): return os.path.getsize(path) * 100 // total
+        return sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(path) for name in names) * 100 // total
+    return sample if total else None
+
+def device_progress(device_id, path, total):
+    # For Job.run: bytes that have arrived at `path` on the device.
+    def sample():
+        success, output = run_command(["adb", "-s", device_id, "shell", f"stat -c %s {shlex.quote(path)}"], timeout=10)
+        return int(output) * 100 // total if success and output.isdigit() else None
+    return sample if total else None
+
+class JobManager:
+    def __init__(self, workers, history):
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, device_id, description, fn, *args):
+        # fn(job, *args) -> (success, message); it may set job.progress/job.result along the way.
+        job = Job(kind, device_id, description)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+            queue = self._pending.get(device_id)
+            if queue is None:
+                self._pending[device_id] = deque()
+                self._executor.submit(self._run, job, fn, args)
+            else:
+                queue.append((job, fn, args, None))
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list(self):
+        return [job.to_dict() for job in reversed(self._jobs.values())]
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[:max(len(self._jobs) - self.history, 0)]: del self._jobs[job_id]
+
+    def run_inline(self, kind, device_id, description, fn, *args):
+        # For work that has to happen inside the request (e.g. consuming an upload stream): the job is
+        # listed, cancellable and waits its turn behind the device's other jobs like any queued job,
+        # but runs on the calling thread. A fan-out job (device_id "a,b,...") waits for every device.
+        job = Job(kind, device_id, description)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+        held = []
+        try:
+            for serial in sorted(set(device_id.split(','))): # a fixed order, so two fan-outs cannot deadlock
+                if not self._wait_turn(job, serial): break
+                held.append(serial)
+            self._execute(job, fn, args)
+        finally:
+            with self._lock:
+                for serial in held: self._advance(serial)
+        return job
+
+    def _wait_turn(self, job, serial):
+        # False when the job was cancelled while waiting.
+        turn = threading.Event()
+        with self._lock:
+            queue = self._pending.get(serial)
+            if queue is None:
+                self._pending[serial] = deque()
+                return True
+            entry = (job, None, None, turn)
+            queue.append(entry)
+        while not turn.wait(0.5):
+            if not job._cancel.is_set(): continue
+            with self._lock:
+                if turn.is_set(): return True
+                self._pending[serial].remove(entry)
+                return False
+        return True
+
+    def _advance(self, serial):
+        # The device's current job is done: start the next one. Called with the lock held.
+        queue = self._pending[serial]
+        if not queue:
+            del self._pending[serial]
+            return
+        job, fn, args, turn = queue.popleft()
+        if turn: turn.set()
+        else: self._executor.submit(self._run, job, fn, args)
+
+    def _run(self, job, fn, args):
+        try:
+            self._execute(job, fn, args)
+        finally:
+            with self._lock: self._advance(job.device_id)
+
+    def _execute(self, job, fn, args):
+        if job._cancel.is_set():
+            job.status, job.message, job.finished = 'cancelled', "Cancelled before it started.", time.time()
+            return
+        job.status, job.started = 'running', time.time()
+        try:
+            with metrics.tagged(f"job:{job.kind}"): success, message = fn(job, *args)
+            job.status, job.message = ('succeeded' if success else 'failed'), message
+            if success: job.progress = 100
+        except JobCancelled:
+            job.status, job.message = 'cancelled', "Cancelled by user."
+        except Exception as e:
+            job.status, job.message = 'failed', f"An unexpected error occurred: {e}"
+        job.finished = time.time()
+
+jobs = JobManager(JOB_WORKERS, JOB_HISTORY)
+
+def job_started(job, message):
+    return jsonify({"status": "success", "job_id": job.id, "message": message}), 202
+
+# --- Streaming Uploads ---
+# Multipart uploads are decoded incrementally and each file chunk is written straight into an
+# `exec:` service on the device (`adb exec-in` when the adb server can't be reached), so nothing is
+# staged on the PC and memory stays bounded by UPLOAD_CHUNK_SIZE.
+installed_apk_hashes = {} # (serial, sha256) -> {"size"}, plus "package" and "apk_path" once resolved, for APKs the panel installed
+
+class StreamedUpload:
+    def __init__(self, req):
+        boundary = req.mimetype_params.get('boundary', '')
+        self.fields = {}
+        self.filename = None
+        self._stream = req.stream
+        self._decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=4 * UPLOAD_CHUNK_SIZE)
+        self._events = self._iter_events()
+        field = None
+        for event in self._events:
+            if isinstance(event, File):
+                self.filename = event.filename
+                break
+            if isinstance(event, Field): field, self.fields[event.name] = event.name, ''
+            elif isinstance(event, Data) and field: self.fields[field] += event.data.decode('utf-8', 'ignore')
+
+    @staticmethod
+    def supported(req):
+        return req.mimetype == 'multipart/form-data' and 'boundary' in req.mimetype_params
+
+    def _iter_events(self):
+        while True:
+            chunk = self._stream.read(UPLOAD_CHUNK_SIZE)
+            self._decoder.receive_data(chunk or None)
+            event = self._decoder.next_event()
+            while not isinstance(event, NeedData):
+                if isinstance(event, Epilogue): return
+                yield event
+                event = self._decoder.next_event()
+            if not chunk: return
+
+    def chunks(self):
+        for event in self._events:
+            if not isinstance(event, Data): break
+            if event.data: yield event.data
+            if not event.more_data: break
+
+class ExecSink:
+    # One device's end of an upload: an exec: service on the adb server, or `adb exec-in` as a fallback.
+    def __init__(self, device_id, command, timeout):
+        self.sock = self.process = None
+        self.call = metrics.start(["adb", "-s", device_id, "exec-in", command], 'server' if USE_ADB_SERVER else 'cli')
+        try:
+            if USE_ADB_SERVER:
+                try: self.sock = adb_server.open_service(device_id, f'exec:{command}', timeout)
+                except OSError: self.call.via('cli')
+            if not self.sock:
+                self.process = subprocess.Popen(
+                    ["adb", "-s", device_id, "exec-in", command], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                    startupinfo=hidden_startupinfo(), start_new_session=os.name != 'nt'
+                )
+                self._watchdog = threading.Timer(timeout, terminate_process, (self.process, True))
+                self._watchdog.start()
+        except BaseException:
+            self.call.close()
+            raise
+
+    def write(self, chunk):
+        if self.sock: self.sock.sendall(chunk)
+        else: self.process.stdin.write(chunk)
+
+    def finish(self):
+        try:
+            if self.sock:
+                with self.sock:
+                    self.sock.shutdown(socket.SHUT_WR)
+                    output = b''.join(iter(lambda: self.sock.recv(65536), b''))
+                return self.call.finish(True, output.decode('utf-8', 'ignore').strip())
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass # the device side went away; its output says why
+            output = self.process.stdout.read()
+            self.process.wait()
+            self._watchdog.cancel()
+            return self.call.finish(self.process.returncode == 0, output.decode('utf-8', 'ignore').strip())
+        finally:
+            self.call.close()
+
+    def abort(self, outcome='failed'):
+        if self.sock: self.sock.close()
+        else:
+            terminate_process(self.process, kill=True)
+            self._watchdog.cancel()
+        self.call.close(outcome)
+
+def stream_to_devices(job, commands, chunks, total_size=None, timeout=600, skip=None):
+    # Reads the upload once and tees each chunk to every device through a small per-device queue, so
+    # the transfer runs at the pace of the slowest device and memory stays bounded. A device that
+    # stops draining for `timeout` seconds is dropped. Returns ({serial: (success, output)}, bytes, sha256).
+    # With `skip`, the last chunk is held back until the whole upload is hashed; skip(sha256) names the
+    # devices that already have this content, and their commands are aborted before they see the end
+    # of the data (their result is (True, None)).
+    digest, written, results, dead = hashlib.sha256(), 0, {}, set()
+    sinks, queues, writers = {}, {}, []
+    for serial, command in commands.items():
+        try: sinks[serial] = ExecSink(serial, command, timeout)
+        except Exception as e: results[serial] = (False, f"error: {e}")
+
+    def drain(serial, sink, chunk_queue):
+        try:
+            for chunk in iter(chunk_queue.get, None): sink.write(chunk)
+            results.setdefault(serial, sink.finish())
+        except Exception as e:
+            sink.abort()
+            dead.add(serial)
+            results.setdefault(serial, (False, f"Upload to device failed: {e}"))
+            while True:
+                try: chunk_queue.get_nowait()
+                except queue.Empty: break
+
+    for serial, sink in sinks.items():
+        queues[serial] = queue.Queue(maxsize=8)
+        writers.append(threading.Thread(target=drain, args=(serial, sink, queues[serial]), daemon=True))
+        writers[-1].start()
+    def send(chunk):
+        for serial, chunk_queue in queues.items():
+            if serial in dead: continue
+            try: chunk_queue.put(chunk, timeout=timeout)
+            except queue.Full:
+                results[serial] = (False, f"Device stopped accepting data for {timeout} seconds.")
+                dead.add(serial)
+                sinks[serial].abort('timeout')
+
+    held = None
+    try:
+        for chunk in chunks:
+            job.check_cancelled()
+            digest.update(chunk)
+            written += len(chunk)
+            if not skip: send(chunk)
+            else:
+                if held is not None: send(held)
+                held = chunk
+            if total_size: job.progress = min(written * 100 // total_size, 99)
+        if skip:
+            for serial in set(skip(digest.hexdigest())) & set(sinks) - dead:
+                results[serial] = (True, None)
+                dead.add(serial)
+                sinks[serial].abort('cancelled')
+            if held is not None: send(held)
+    except BaseException as e:
+        for serial, sink in sinks.items():
+            dead.add(serial)
+            sink.abort('cancelled' if isinstance(e, JobCancelled) else 'failed')
+        raise
+    finally:
+        for serial, chunk_queue in queues.items():
+            try: chunk_queue.put(None, timeout=timeout if serial not in dead else 0)
+            except queue.Full: pass
+        for writer in writers: writer.join(timeout)
+    job.check_cancelled()
+    for serial in commands: results.setdefault(serial, (False, "Upload to device did not finish."))
+    return results, written, digest.hexdigest()
+
+def stream_to_device(job, device_id, command, chunks, total_size=None, timeout=600, skip=None):
+    # Returns (success, output, bytes_written, sha256_hex); `command` runs under `sh -c` on the device.
+    results, written, sha256 = stream_to_devices(job, {device_id: command}, chunks, total_size, timeout, skip)
+    return (*results[device_id], written, sha256)
+
+def streamed_push_job(job, device_id, upload, phone_path, filename, total_size):
+    _, output, written, _ = stream_to_device(job, device_id, f"cat > {shlex.quote(phone_path)}", upload.chunks(), total_size)
+    success, size = run_command(["adb", "-s", device_id, "shell", f"stat -c %s {shlex.quote(phone_path)}"])
+    file_listings.invalidate(device_id, posixpath.dirname(phone_path))
+    if success and size.strip() == str(written) and (not total_size or written == total_size):
+        job.result = {"path": phone_path, "bytes": written}
+        return True, f"Pushed {filename}."
+    run_command(["adb", "-s", device_id, "shell", f"rm -f {shlex.quote(phone_path)}"])
+    return False, f"Failed to push file: {output or size}"
+
+def apk_install_result(output, written, size):
+    if written != size: return False, f"Failed to install APK: received {written} bytes but expected {size}."
+    if "Success" in output or "success" in output.lower(): return True, None
+    return False, f"Failed to install APK: {output}"
+
+def remember_installed_apk(serial, sha256, size):
+    # Only the hash and size: working out the package costs a catalog build and an on-device hash, so
+    # it waits for the first skip check that needs it.
+    installed_apk_hashes[(serial, sha256)] = {"size": size}
+
+def resolve_installed_apk(serial, sha256, record):
+    # A single-APK install leaves the uploaded file byte for byte as the package's base.apk, so the
+    # package is the one whose APK has the same size and hash.
+    entry, _ = package_catalog.get(serial)
+    candidates = {package["apk_path"]: package["package"] for package in (entry or {}).get("packages", {}).values() if package["apk_size"] == record["size"]}
+    if not candidates: return False
+    _, output = run_command(["adb", "-s", serial, "shell", "sha256sum " + ' '.join(shlex.quote(path) for path in candidates)])
+    for line in output.splitlines():
+        digest, _, path = line.partition('  ')
+        if digest == sha256 and path in candidates:
+            forget_installed_apks(serial, candidates[path]) # one entry per package
+            installed_apk_hashes[(serial, sha256)] = {**record, "package": candidates[path], "apk_path": path}
+            return True
+    return False
+
+def forget_installed_apks(serial, package=None):
+    for key in [key for key, record in list(installed_apk_hashes.items()) if key[0] == serial and package in (None, record.get("package"))]:
+        installed_apk_hashes.pop(key, None)
+
+def apk_already_installed(serial, sha256):
+    # Only when the device confirms the package still has the APK the panel installed; an update,
+    # uninstall or reset done elsewhere changes or removes its path.
+    record = installed_apk_hashes.get((serial, sha256))
+    if not record: return False
+    if "package" in record:
+        success, output = run_command(["adb", "-s", serial, "shell", f"pm path {shlex.quote(record['package'])}"])
+        if success and f"package:{record['apk_path']}" in output.split(): return True
+    elif resolve_installed_apk(serial, sha256, record): return True
+    installed_apk_hashes.pop((serial, sha256), None)
+    return False
+
+def already_installed(serials, force):
+    # For stream_to_devices(skip=...): identical APKs are recognised by the hash of the upload itself,
+    # and every device is checked at once.
+    if force: return lambda sha256: ()
+    def check(sha256):
+        results = fan_out(serials, lambda serial: {"status": "success", "installed": apk_already_installed(serial, sha256)})
+        return [serial for serial, result in results.items() if result.get("installed")]
+    return check
+
+def streamed_install_job(job, device_id, upload, size, filename, force=False):
+    success, output, written, sha256 = stream_to_device(job, device_id, f"pm install -r -S {size}", upload.chunks(), size, skip=already_installed([device_id], force))
+    if success and output is None:
+        job.result = {"sha256": sha256, "bytes": written, "skipped": True}
+        return True, "This APK is already installed on the device. Skipped."
+    installed, error = apk_install_result(output, written, size)
+    package_catalog.invalidate(device_id)
+    if success and installed:
+        remember_installed_apk(device_id, sha256, written)
+        job.result = {"sha256": sha256, "bytes": written}
+        return True, f"Successfully installed {filename}."
+    return False, error or f"Failed to install APK: {output}"
+
+def fanout_install_job(job, targets, upload, size, filename, missing, force=False):
+    command = f"pm install -r -S {size}"
+    outcomes, written, sha256 = stream_to_devices(job, {serial: command for serial in targets}, upload.chunks(), size, FANOUT_TIMEOUT, already_installed(targets, force))
+    results = dict(missing)
+    for serial, (success, output) in outcomes.items():
+        if success and output is None:
+            results[serial] = {"status": "success", "skipped": True, "message": "Already installed. Skipped."}
+            continue
+        package_catalog.invalidate(serial)
+        installed, error = apk_install_result(output, written, size)
+        if success and installed:
+            remember_installed_apk(serial, sha256, written)
+            results[serial] = {"status": "success", "message": f"Successfully installed {filename}."}
+        else:
+            results[serial] = {"status": "error", "message": error or f"Failed to install APK: {output}"}
+    job.result = {"sha256": sha256, "bytes": written, "results": results}
+    ok = sum(result["status"] == "success" for result in results.values())
+    return ok == len(results), f"Installed {filename} on {ok}/{len(results)} devices."
+
+# --- Multi-Device Fan-out ---
+# Requests can name several devices ("targets": [...] or "all" in JSON, X-Device-Targets for
+# uploads). Each device runs on a shared bounded pool with its own timeout, and the response
+# carries one result per device so partial successes are visible.
+fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='fanout')
+
+def ready_devices():
+    if USE_ADB_SERVER:
+        device_registry.start()
+        if device_registry.tracking: return [device['serial'] for device in device_registry.snapshot() if device['state'] == 'device']
+    success, output = run_command(["adb", "devices"])
+    if not success: return []
+    return [line.split('\t')[0] for line in output.split('\n')[1:] if '\tdevice' in line]
+
+def requested_targets():
+    # Returns None for a normal single-device request, else (ready serials, {serial: error result}).
+    targets = (request.get_json(silent=True) or {}).get('targets') if request.is_json else None
+    if targets is None: targets = request.headers.get('X-Device-Targets')
+    if not targets: return None
+    ready = ready_devices()
+    if isinstance(targets, str):
+        targets = 'all' if targets.strip() == 'all' else [serial.strip() for serial in targets.split(',') if serial.strip()]
+    if targets == 'all': return ready, {}
+    targets = list(dict.fromkeys(str(serial) for serial in targets))
+    missing = {serial: {"status": "error", "message": "Device not connected."} for serial in targets if serial not in ready}
+    return [serial for serial in targets if serial in ready], missing
+
+def fan_out(serials, fn, timeout=FANOUT_TIMEOUT):
+    # fn(serial) -> result dict with at least "status"; the timeout counts from when the device's turn starts.
+    started, results = {}, {}
+    route = metrics.current_route()
+
+    def call(serial):
+        started[serial] = time.monotonic()
+        with metrics.tagged(route): return fn(serial)
+
+    futures = {fanout_pool.submit(call, serial): serial for serial in serials}
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+        for future in done:
+            try: results[futures[future]] = future.result()
+            except Exception as e: results[futures[future]] = {"status": "error", "message": f"An unexpected error occurred: {e}"}
+        now = time.monotonic()
+        for future in list(pending):
+            serial = futures[future]
+            if serial in started and now - started[serial] > timeout:
+                results[serial] = {"status": "error", "message": f"Timed out after {timeout} seconds."}
+                pending.discard(future)
+    return results
+
+def fan_out_response(results, **extra):
+    ok = sum(result["status"] == "success" for result in results.values())
+    status = "success" if results and ok == len(results) else ("partial" if ok else "error")
+    payload = {"status": status, "message": f"{ok}/{len(results)} devices succeeded.", "results": results, **extra}
+    return jsonify(payload), (200 if ok else 500)
+
+# --- Live Shell Streams ---
+# Each stream owns one `adb shell` child and a ring buffer of its output lines. Subscribers follow
+# it over Server-Sent Events with their own cursor; when the ring is full the reader waits (up to
+# SHELL_STREAM_BACKPRESSURE) for the slowest subscriber, which in turn stalls the adb pipe. Late
+# subscribers replay whatever the ring still holds and get a "gap" event for anything dropped.
+class ShellStream:
+    def __init__(self, device_id, command, capacity):
+        self.id = uuid.uuid4().hex[:12]
+        self.device_id = device_id
+        self.command = command
+        self.created = time.time()
+        self.last_seen = time.monotonic()
+        self.exit_code = None
+        self.done = False
+        self._lines = deque(maxlen=capacity)
+        self._first_seq = 0
+        self._next_seq = 0
+        self._cursors = {}
+        self._lagging = set()
+        self._cond = threading.Condition()
+        self._cancelled = False
+        self._call = metrics.start(["adb", "-s", device_id, "shell"] + command.split(), slow=False)
+        try:
+            self._process = subprocess.Popen(
+                self._call.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                startupinfo=hidden_startupinfo(), start_new_session=os.name != 'nt'
+            )
+        except BaseException:
+            self._call.close()
+            raise
+        threading.Thread(target=self._read, name=f'shell-stream-{self.id}', daemon=True).start()
+
+    def to_dict(self):
+        return {
+            "id": self.id, "device": self.device_id, "command": self.command, "created": self.created,
+            "done": self.done, "exit_code": self.exit_code, "lines": self._next_seq, "subscribers": len(self._cursors),
+        }
+
+    def _read(self):
+        for raw in iter(self._process.stdout.readline, b''):
+            line = raw.decode('utf-8', 'ignore').rstrip('\r\n')
+            with self._cond:
+                deadline = time.monotonic() + SHELL_STREAM_BACKPRESSURE
+                while len(self._lines) == self._lines.maxlen and self._blocking_subscribers():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        # Stop waiting for these until they catch up; they will see a gap instead.
+                        self._lagging.update(self._blocking_subscribers())
+                        break
+                    self._cond.wait(remaining)
+                if len(self._lines) == self._lines.maxlen: self._first_seq += 1
+                self._lines.append(line)
+                self._next_seq += 1
+                self._cond.notify_all()
+        self._process.wait()
+        self._call.close('ok' if self._process.returncode == 0 else 'cancelled' if self._cancelled else 'failed')
+        with self._cond:
+            self.exit_code = self._process.returncode
+            self.done = True
+            self.last_seen = time.monotonic()
+            self._cond.notify_all()
+
+    def _blocking_subscribers(self):
+        return [token for token, cursor in self._cursors.items() if cursor <= self._first_seq and token not in self._lagging]
+
+    def cancel(self):
+        self._cancelled = True
+        terminate_process(self._process)
+
+    def events(self, since=None):
+        # Yields SSE frames from sequence number `since` (default: oldest line still buffered).
+        token = object()
+        with self._cond:
+            cursor = self._first_seq if since is None else max(since, 0)
+            self._cursors[token] = cursor
+        try:
+            yield sse_frame({"id": self.id, "device": self.device_id, "command": self.command}, event='session')
+            while True:
+                with self._cond:
+                    if cursor >= self._next_seq and not self.done: self._cond.wait(15)
+                    dropped = self._first_seq - cursor
+                    if dropped > 0: cursor = self._first_seq
+                    batch = list(self._lines)[cursor - self._first_seq:]
+                    start, finished, exit_code = cursor, self.done, self.exit_code
+                if dropped > 0: yield sse_frame({"dropped": dropped}, event='gap')
+                if batch:
+                    yield ''.join(f"id: {start + i}\ndata: {line}\n\n" for i, line in enumerate(batch))
+                    cursor = start + len(batch)
+                    with self._cond:
+                        self._cursors[token] = cursor
+                        self._lagging.discard(token)
+                        self._cond.notify_all()
+                elif finished:
+                    yield sse_frame({"exit_code": exit_code}, event='exit')
+                    return
+                else:
+                    yield ': keep-alive\n\n'
+        finally:
+            with self._cond:
+                self._cursors.pop(token, None)
+                self._lagging.discard(token)
+                self.last_seen = time.monotonic()
+                self._cond.notify_all()
+
+def sse_frame(data, event=None):
+    return (f"event: {event}\n" if event else '') + f"data: {json.dumps(data)}\n\n"
+
+def sse_response(frames):
+    return Response(frames, mimetype='text/event-stream', headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+shell_streams = {}
+_shell_reaper = None
+_shell_reaper_lock = threading.Lock()
+
+def reap_shell_streams():
+    now = time.monotonic()
+    with _shell_reaper_lock:
+        for stream_id, stream in list(shell_streams.items()):
+            if stream.to_dict()["subscribers"] or now - stream.last_seen < SHELL_STREAM_IDLE: continue
+            stream.cancel()
+            if stream.done: shell_streams.pop(stream_id, None)
+
+def add_shell_stream(stream):
+    # The reaper runs while any stream exists, so an abandoned `logcat` is stopped even if no
+    # request ever touches the stream routes again.
+    global _shell_reaper
+    with _shell_reaper_lock:
+        shell_streams[stream.id] = stream
+        if _shell_reaper is None:
+            _shell_reaper = threading.Thread(target=_reap_shell_streams_loop, name='shell-stream-reaper', daemon=True)
+            _shell_reaper.start()
+
+def _reap_shell_streams_loop():
+    global _shell_reaper
+    while True:
+        time.sleep(min(max(SHELL_STREAM_IDLE / 10, 1), 30))
+        reap_shell_streams()
+        with _shell_reaper_lock:
+            if not shell_streams:
+                _shell_reaper = None
+                return
+
+def job_finished(job):
+    payload = {"status": "success" if job.status == 'succeeded' else "error", "job_id": job.id, "message": job.message}
+    if (job.result or {}).get("skipped"): payload["skipped"] = True
+    return jsonify(payload), (200 if job.status == 'succeeded' else 500)
+
+# --- Device Info Snapshot ---
+# Every stale section is fetched in one batched shell call and parsed in a single pass. Sections
+# with a TTL of None stay cached until the device registry reports a disconnect/reconnect.
+BATTERY_STATUS_CODES = {"1": "Unknown", "2": "Charging", "3": "Discharging", "4": "Not charging", "5": "Full"}
+SECTION_MARKER = '@@nexus:'
+
+def parse_props(text):
+    values = (text.split('\n') + ['', '', ''])[:3]
+    return {"model": values[0].strip(), "android_version": values[1].strip(), "serial": values[2].strip()}
+
+def parse_battery(text):
+    level_match = re.search(r'level: (\d+)', text)
+    status_match = re.search(r'status: (\d+)', text)
+    return {
+        "battery_level": level_match.group(1) if level_match else "N/A",
+        "battery_status": BATTERY_STATUS_CODES.get(status_match.group(1), "N/A") if status_match else "N/A",
+    }
+
+def parse_cpu(text):
+    cpu_model_match = re.search(r'Hardware\s+:\s+(.*)', text)
+    return {"cpu": cpu_model_match.group(1).strip() if cpu_model_match else "N/A"}
+
+def parse_ram(text):
+    mem_total_match = re.search(r'MemTotal:\s+(\d+)\s+kB', text)
+    return {"ram": f"{int(mem_total_match.group(1)) // 1024} MB" if mem_total_match else "N/A"}
+
+DEVICE_INFO_SECTIONS = {
+    # name: (shell snippet, parser, ttl in seconds or None)
+    'props': ("getprop ro.product.model; getprop ro.build.version.release; getprop ro.serialno", parse_props, None),
+    'cpu': ("grep -m 1 '^Hardware' /proc/cpuinfo", parse_cpu, None),
+    'ram': ("grep -m 1 '^MemTotal' /proc/meminfo", parse_ram, None),
+    'battery': ("dumpsys battery", parse_battery, BATTERY_INFO_TTL),
+}
+
+def batch_shell_script(sections):
+    return '; '.join(f"echo '{SECTION_MARKER}{name}'; {snippet}" for name, snippet in sections.items())
+
+def split_sections(output):
+    sections, name, lines = {}, None, []
+    for line in output.split('\n'):
+        if line.startswith(SECTION_MARKER):
+            if name: sections[name] = '\n'.join(lines)
+            name, lines = line[len(SECTION_MARKER):].strip(), []
+        elif name:
+            lines.append(line.rstrip('\r'))
+    if name: sections[name] = '\n'.join(lines)
+    return sections
+
+class DeviceCache:
+    # One entry per device; a rebuild holds only that device's lock, so a slow phone never blocks the others.
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._device_locks = {}
+
+    def invalidate(self, serial):
+        with self._lock:
+            self._entries.pop(serial, None)
+
+    def _device_lock(self, serial):
+        with self._lock:
+            return self._device_locks.setdefault(serial, threading.Lock())
+
+class DeviceInfoCache(DeviceCache):
+    def __init__(self, sections):
+        super().__init__()
+        self.sections = sections
+
+    def get(self, serial, refresh=False):
+        with self._device_lock(serial):
+            now = time.monotonic()
+            entry = self._entries.get(serial, {})
+            stale = {
+                name: snippet for name, (snippet, _, ttl) in self.sections.items()
+                if refresh or name not in entry or (ttl is not None and now - entry[name][0] > ttl)
+            }
+            if stale:
+                _, output = run_command(["adb", "-s", serial, "shell", batch_shell_script(stale)])
+                raw = split_sections(output)
+                entry = dict(entry)
+                for name in stale:
+                    entry[name] = (now, self.sections[name][1](raw.get(name, '')))
+                # Only remember results when the script actually ran on the device.
+                if all(name in raw for name in stale):
+                    with self._lock:
+                        self._entries[serial] = entry
+        info = {}
+        for _, fields in entry.values(): info.update(fields)
+        return info
+
+device_info_cache = DeviceInfoCache(DEVICE_INFO_SECTIONS)
+
+# --- Package Catalog ---
+# Third-party packages with version, size and install times, built from one batched shell call and
+# kept per device. Installs/uninstalls through the panel and device reconnects drop the catalog;
+# changes made elsewhere (Play Store, adb on another PC) are caught by an md5 of the package list
+# that is compared at most once every PACKAGE_CATALOG_VERIFY seconds. `pm` is slow to start, so a
+# build lists the packages once into a shell variable and derives the APK sizes and md5 from it.
+PACKAGE_LIST = 'packages=$(pm list packages -3 -f -U --show-versioncode)'
+PACKAGE_FINGERPRINT = f'{PACKAGE_LIST}; echo "$packages" | md5sum'
+PACKAGE_CATALOG_SECTIONS = {
+    'packages': f'{PACKAGE_LIST}; echo "$packages"',
+    'details': "dumpsys package packages | grep -E '^  Package \\[|^    (versionName|firstInstallTime|lastUpdateTime)='",
+    'sizes': 'echo "$packages" | sed -n \'s/^package:\\(.*\\)=.*/\\1/p\' | xargs stat -c \'%s %n\' 2>/dev/null',
+    'fingerprint': 'echo "$packages" | md5sum',
+}
+PACKAGE_LINE_RE = re.compile(r'^package:(?:(.*)=)?([\w.]+)(?:\s+versionCode:(\d+))?(?:\s+uid:(\d+))?')
+PACKAGE_DETAIL_FIELDS = {"versionName": "version_name", "firstInstallTime": "first_install", "lastUpdateTime": "last_update"}
+PACKAGE_SORT_FIELDS = {"size": "apk_size", "installed": "first_install", "updated": "last_update"}
+
+def parse_package_catalog(raw):
+    packages = {}
+    for line in raw.get('packages', '').split('\n'):
+        match = PACKAGE_LINE_RE.match(line.strip())
+        if not match: continue
+        path, name, version_code, uid = match.groups()
+        packages[name] = {
+            "package": name, "version_name": None, "version_code": int(version_code) if version_code else None,
+            "uid": int(uid) if uid else None, "apk_path": path, "apk_size": None, "first_install": None, "last_update": None,
+        }
+    sizes = {}
+    for line in raw.get('sizes', '').split('\n'):
+        size, _, path = line.strip().partition(' ')
+        if size.isdigit(): sizes[path] = int(size)
+    current = None
+    for line in raw.get('details', '').split('\n'):
+        line = line.strip()
+        if line.startswith('Package ['):
+            current = packages.get(line[len('Package ['):line.find(']')])
+            continue
+        key, sep, value = line.partition('=')
+        if current is not None and sep and key in PACKAGE_DETAIL_FIELDS and current[PACKAGE_DETAIL_FIELDS[key]] is None:
+            current[PACKAGE_DETAIL_FIELDS[key]] = value.strip()
+    for package in packages.values(): package["apk_size"] = sizes.get(package["apk_path"])
+    return packages
+
+class PackageCatalog(DeviceCache):
+    def __init__(self, verify_after):
+        super().__init__()
+        self.verify_after = verify_after
+
+    def get(self, serial, refresh=False):
+        # Returns (catalog entry, None) or (None, error message).
+        with self._device_lock(serial):
+            entry = self._entries.get(serial)
+            now = time.monotonic()
+            if entry and not refresh:
+                if now - entry["checked"] < self.verify_after: return entry, None
+                success, output = run_command(["adb", "-s", serial, "shell", PACKAGE_FINGERPRINT])
+                if success and output.split()[:1] == [entry["fingerprint"]]:
+                    entry["checked"] = now
+                    return entry, None
+            success, output = run_command(["adb", "-s", serial, "shell", batch_shell_script(PACKAGE_CATALOG_SECTIONS)], timeout=60)
+            raw = split_sections(output)
+            packages = parse_package_catalog(raw)
+            if not all(name in raw for name in PACKAGE_CATALOG_SECTIONS) or (raw['packages'].strip() and not packages):
+                return None, output.strip()[:200] or "No output from the device."
+            names = sorted(packages, key=str.lower)
+            entry = {
+                "packages": packages, "names": names, "keys": [name.lower() for name in names],
+                "fingerprint": (raw['fingerprint'].split() or [None])[0], "checked": now, "built": time.time(),
+            }
+            with self._lock:
+                self._entries[serial] = entry
+            return entry, None
+
+def search_packages(entry, query='', match='substring', sort='name'):
+    # Prefix queries are a bisect over the sorted lower-cased names; substring queries scan them.
+    query = query.strip().lower()
+    names, keys, packages = entry["names"], entry["keys"], entry["packages"]
+    if query and match == 'prefix':
+        selected = names[bisect.bisect_left(keys, query):bisect.bisect_left(keys, query + '\uffff')]
+    elif query:
+        selected = [name for name, key in zip(names, keys) if query in key]
+    else:
+        selected = names
+    field = PACKAGE_SORT_FIELDS.get(sort)
+    if field: selected = sorted(selected, key=lambda name: packages[name][field] or (0 if field == 'apk_size' else ''), reverse=True)
+    return [packages[name] for name in selected]
+
+package_catalog = PackageCatalog(PACKAGE_CATALOG_VERIFY)
+
+# --- Device Telemetry ---
+# The sampler polls each device once per interval with a single batched shell call. Every metric
+# is a RingSeries backed by two preallocated array('d') buffers, so memory per device is fixed no
+# matter how long the sampler runs; queries reduce a window to min/max/avg buckets on the fly.
+TELEMETRY_SECTIONS = {
+    'battery': "dumpsys battery",
+    'meminfo': "grep -E '^(MemTotal|MemAvailable|MemFree|Cached):' /proc/meminfo",
+    'stat': "head -n 1 /proc/stat",
+    'procs': "ps -A -o RSS,NAME",
+}
+TELEMETRY_METRICS = ('battery_level', 'battery_temp_c', 'mem_used_kb', 'mem_available_kb', 'cpu_percent')
+
+def parse_battery_sample(text):
+    level = parse_battery(text)["battery_level"]
+    temperature_match = re.search(r'temperature: (-?\d+)', text)
+    return {
+        "battery_level": float(level) if level.isdigit() else None,
+        "battery_temp_c": int(temperature_match.group(1)) / 10 if temperature_match else None, # reported in tenths of a degree
+    }
+
+def parse_meminfo_sample(text):
+    fields = {key: int(value) for key, value in re.findall(r'^(\w+):\s+(\d+)', text, re.M)}
+    total = fields.get('MemTotal')
+    if 'MemAvailable' in fields: available = fields['MemAvailable']
+    elif 'MemFree' in fields: available = fields['MemFree'] + fields.get('Cached', 0) # kernels older than 3.14
+    else: available = None
+    return {"mem_available_kb": available, "mem_used_kb": total - available if total and available is not None else None}
+
+def parse_cpu_jiffies(text):
+    # (busy, total) jiffies from the aggregate "cpu" line of /proc/stat.
+    parts = text.split()
+    if len(parts) < 5 or parts[0] != 'cpu': return None
+    jiffies = [int(part) for part in parts[1:9] if part.isdigit()]
+    idle = sum(jiffies[3:5]) # idle + iowait
+    return sum(jiffies) - idle, sum(jiffies)
+
+def parse_process_rss(text, limit):
+    # Largest `limit` processes by RSS (kB); processes sharing a name are summed.
+    totals = {}
+    for line in text.split('\n')[1:]:
+        rss, _, name = line.strip().partition(' ')
+        name = name.strip()
+        if rss.isdigit() and name: totals[name] = totals.get(name, 0) + int(rss)
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+class RingSeries:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._next = 0
+
+    def append(self, timestamp, value):
+        self._times[self._next] = timestamp
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def samples(self, start=None, end=None):
+        # (timestamp, value) pairs, oldest first, limited to [start, end].
+        first = (self._next - self.count) % self.capacity
+        for i in range(self.count):
+            index = (first + i) % self.capacity
+            timestamp = self._times[index]
+            if start is not None and timestamp < start: continue
+            if end is not None and timestamp > end: break
+            yield timestamp, self._values[index]
+
+    def downsample(self, start, end, buckets):
+        # Buckets with no samples are left out so gaps (device offline, sampler stopped) stay visible.
+        width = max((end - start) / buckets, 1e-6)
+        reduced = {}
+        for timestamp, value in self.samples(start, end):
+            slot = min(int((timestamp - start) / width), buckets - 1)
+            bucket = reduced.get(slot)
+            if bucket is None: reduced[slot] = [value, value, value, 1]
+            else:
+                if value < bucket[0]: bucket[0] = value
+                if value > bucket[1]: bucket[1] = value
+                bucket[2] += value
+                bucket[3] += 1
+        return [
+            {"t": round(start + (slot + 0.5) * width, 3), "min": low, "max": high, "avg": round(total / n, 3), "samples": n}
+            for slot, (low, high, total, n) in sorted(reduced.items())
+        ]
+
+class DeviceTelemetry:
+    def __init__(self, capacity, max_processes):
+        self.capacity = capacity
+        self.max_processes = max_processes
+        self.series = {name: RingSeries(capacity) for name in TELEMETRY_METRICS}
+        self.processes = OrderedDict() # name -> RingSeries, least recently seen first
+        self.last_sample = None
+        self.lock = threading.Lock()
+        self._last_jiffies = None
+
+    def record(self, timestamp, raw, top_processes):
+        values = {**parse_battery_sample(raw.get('battery', '')), **parse_meminfo_sample(raw.get('meminfo', ''))}
+        jiffies = parse_cpu_jiffies(raw.get('stat', ''))
+        with self.lock:
+            if jiffies and self._last_jiffies:
+                busy, total = jiffies[0] - self._last_jiffies[0], jiffies[1] - self._last_jiffies[1]
+                # Counters go backwards after a reboot; skip that interval rather than record nonsense.
+                if total > 0 and busy >= 0: values['cpu_percent'] = round(100 * busy / total, 2)
+            self._last_jiffies = jiffies
+            for name, value in values.items():
+                if value is not None: self.series[name].append(timestamp, value)
+            for name, rss in parse_process_rss(raw.get('procs', ''), top_processes):
+                series = self.processes.get(name)
+                if series is None: series = self.processes[name] = RingSeries(self.capacity)
+                else: self.processes.move_to_end(name)
+                series.append(timestamp, rss)
+            while len(self.processes) > self.max_processes: self.processes.popitem(last=False)
+            self.last_sample = timestamp
+
+    def query(self, start, end, buckets, metrics=None, processes=None):
+        # `processes` is None for every tracked process, or a list of names.
+        with self.lock:
+            series = {name: ring.downsample(start, end, buckets) for name, ring in self.series.items() if not metrics or name in metrics}
+            process_series = {
+                name: ring.downsample(start, end, buckets) for name, ring in self.processes.items()
+                if processes is None or name in processes
+            }
+        return {"series": series, "processes_rss_kb": process_series, "last_sample": self.last_sample}
+
+class TelemetrySampler:
+    def __init__(self, capacity, max_processes, top_processes):
+        self.capacity = capacity
+        self.max_processes = max_processes
+        self.top_processes = top_processes
+        self.interval = TELEMETRY_INTERVAL
+        self.targets = None # None samples every ready device
+        self.running = False
+        self._devices = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self, interval=None, targets=None):
+        with self._lock:
+            if interval: self.interval = max(float(interval), 1.0)
+            self.targets = targets
+            self.running = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='telemetry', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def device(self, serial, create=False):
+        with self._lock:
+            telemetry = self._devices.get(serial)
+            if telemetry is None and create:
+                telemetry = self._devices[serial] = DeviceTelemetry(self.capacity, self.max_processes)
+            return telemetry
+
+    def status(self):
+        with self._lock:
+            devices = {serial: telemetry.last_sample for serial, telemetry in self._devices.items()}
+        return {"running": self.running, "interval": self.interval, "targets": self.targets or "all", "devices": devices}
+
+    def sample(self, serial):
+        script = batch_shell_script(TELEMETRY_SECTIONS)
+        success, output = run_command(["adb", "-s", serial, "shell", script], timeout=max(self.interval * 2, 10))
+        raw = split_sections(output) if success else {}
+        if not all(name in raw for name in TELEMETRY_SECTIONS):
+            return {"status": "error", "message": f"Sampling failed: {output.strip()[:200]}"}
+        self.device(serial, create=True).record(time.time(), raw, self.top_processes)
+        return {"status": "success"}
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                if not self.running:
+                    self._thread = None
+                    return
+            self._wake.clear()
+            started = time.monotonic()
+            ready = ready_devices()
+            serials = ready if self.targets is None else [serial for serial in self.targets if serial in ready]
+            if serials: fan_out(serials, self.sample, timeout=max(self.interval * 2, 10))
+            self._wake.wait(max(self.interval - (time.monotonic() - started), 0))
+
+telemetry_sampler = TelemetrySampler(TELEMETRY_CAPACITY, TELEMETRY_MAX_PROCESSES, TELEMETRY_TOP_PROCESSES)
+
+# --- LAN Scanner ---
+# Probes every address of a network concurrently on one asyncio loop: TCP connects to SCAN_PORTS,
+# where a refused connection counts as "up" just like an open one, plus the OS ARP/neighbour table
+# for hosts that silently drop connects. Results are cached per host so a rescan only re-probes
+# stale addresses. python-nmap, when installed, is only used to look up MAC vendors.
+NEIGHBOR_RE = re.compile(r'(\d{1,3}(?:\.\d{1,3}){3})\D.*?\b([0-9a-fA-F]{1,2}(?:[:-][0-9a-fA-F]{1,2}){5})\b')
+
+def read_neighbor_table():
+    # {ip: mac} for complete entries of the OS ARP cache.
+    if os.path.exists('/proc/net/arp'):
+        with open('/proc/net/arp') as f: text = f.read()
+    else:
+        try: text = subprocess.run(["arp", "-a"], capture_output=True, text=True, timeout=5, startupinfo=hidden_startupinfo()).stdout
+        except (OSError, subprocess.TimeoutExpired): return {}
+    neighbors = {}
+    for ip, mac in NEIGHBOR_RE.findall(text):
+        mac = ':'.join(part.zfill(2) for part in re.split('[:-]', mac.lower()))
+        if mac not in ('00:00:00:00:00:00', 'ff:ff:ff:ff:ff:ff'): neighbors[ip] = mac
+    return neighbors
+
+def local_network():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.settimeout(0.1)
+        s.connect(("8.8.8.8", 80))
+        return ipaddress.ip_network(s.getsockname()[0] + "/24", strict=False)
+    finally: s.close()
+
+def nmap_vendors(ips):
+    nm = nmap.PortScanner()
+    nm.scan(hosts=' '.join(ips), arguments='-sn')
+    vendors = {}
+    for host_ip in nm.all_hosts():
+        mac_address = nm[host_ip].get('addresses', {}).get('mac')
+        if mac_address: vendors[mac_address.lower()] = nm[host_ip]['vendor'].get(mac_address, 'Unknown')
+    return vendors
+
+async def probe_port(ip, port, timeout, semaphore):
+    # 'open', 'closed' (refused, so the host is up) or None when nothing answered.
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+        except ConnectionRefusedError: return 'closed'
+        except (asyncio.TimeoutError, OSError): return None
+        writer.close()
+        return 'open'
+
+class LanScanner:
+    def __init__(self, ttl, down_ttl, capacity=8192):
+        self.ttl = ttl
+        self.down_ttl = down_ttl
+        self.capacity = capacity
+        self._cache = OrderedDict() # (ip, ports) -> (checked, host dict, or None when it did not answer)
+        self._vendors = {} # mac -> vendor, filled in by the optional nmap lookup
+        self._lock = threading.Lock()
+
+    def _cached(self, key, now):
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry and now - entry[0] < (self.ttl if entry[1] else self.down_ttl): return entry
+        return None
+
+    def _store(self, key, now, host):
+        with self._lock:
+            self._cache[key] = (now, host)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.capacity: self._cache.popitem(last=False)
+
+    def _host(self, ip, open_ports, mac, source):
+        return {
+            "ip": ip, "vendor": self._vendors.get(mac, 'Unknown') if mac else 'N/A', "mac": mac or 'N/A',
+            "open_ports": open_ports, "adb": 5555 in open_ports, "source": source,
+        }
+
+    def scan(self, network, ports, emit, stop=None, enrich=True):
+        # Blocking. emit(host) is called for each live host as soon as it answers, and again if its
+        # MAC or vendor is filled in later. Returns a summary of the run.
+        return asyncio.run(self._scan(network, ports, emit, stop or threading.Event(), enrich))
+
+    async def _scan(self, network, ports, emit, stop, enrich):
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        neighbors = await loop.run_in_executor(None, read_neighbor_table)
+        addresses = [str(ip) for ip in network.hosts()] or [str(network.network_address)]
+        ports = tuple(ports)
+        found, stale = {}, []
+        for ip in addresses:
+            entry = self._cached((ip, ports), time.monotonic())
+            if entry is None: stale.append(ip)
+            elif entry[1]:
+                found[ip] = dict(entry[1], cached=True)
+                emit(found[ip])
+        semaphore = asyncio.Semaphore(SCAN_CONCURRENCY)
+
+        async def probe(ip):
+            if stop.is_set(): return ip, None
+            return ip, await asyncio.gather(*(probe_port(ip, port, SCAN_TIMEOUT, semaphore) for port in ports))
+
+        answered = set()
+        for next_done in asyncio.as_completed([probe(ip) for ip in stale]):
+            ip, states = await next_done
+            if states is None or not any(state is not None for state in states): continue
+            answered.add(ip)
+            host = self._host(ip, [port for port, state in zip(ports, states) if state == 'open'], neighbors.get(ip), 'tcp')
+            self._store((ip, ports), time.monotonic(), host)
+            found[ip] = dict(host, cached=False)
+            emit(found[ip])
+        if stop.is_set(): return self._summary(network, ports, addresses, stale, found, started, stopped=True)
+
+        # The probes refreshed the ARP cache: it now also lists hosts that drop TCP connects.
+        neighbors = await loop.run_in_executor(None, read_neighbor_table)
+        for ip in stale:
+            if ip in answered:
+                if found[ip]['mac'] == 'N/A' and ip in neighbors:
+                    found[ip] = dict(self._host(ip, found[ip]['open_ports'], neighbors[ip], 'tcp'), cached=False)
+                    self._store((ip, ports), time.monotonic(), dict(found[ip]))
+                    emit(found[ip])
+            elif ip in neighbors:
+                host = self._host(ip, [], neighbors[ip], 'arp')
+                self._store((ip, ports), time.monotonic(), host)
+                found[ip] = dict(host, cached=False)
+                emit(found[ip])
+            else:
+                self._store((ip, ports), time.monotonic(), None)
+
+        summary = self._summary(network, ports, addresses, stale, found, started)
+        unknown = sorted({ip for ip, host in found.items() if host['mac'] != 'N/A' and host['mac'] not in self._vendors})
+        if enrich and nmap is not None and unknown:
+            try: self._vendors.update(await loop.run_in_executor(None, nmap_vendors, unknown))
+            except Exception as e: summary["vendor_error"] = f"Vendor lookup failed: {e}"
+            for ip in unknown:
+                if found[ip]['mac'] in self._vendors:
+                    found[ip] = dict(found[ip], vendor=self._vendors[found[ip]['mac']])
+                    emit(found[ip])
+        summary["elapsed"] = round(time.monotonic() - started, 3)
+        return summary
+
+    @staticmethod
+    def _summary(network, ports, addresses, stale, found, started, stopped=False):
+        return {
+            "network": str(network), "ports": list(ports), "addresses": len(addresses), "probed": len(stale),
+            "cached": len(addresses) - len(stale), "found": len(found), "stopped": stopped,
+            "elapsed": round(time.monotonic() - started, 3),
+        }
+
+lan_scanner = LanScanner(SCAN_CACHE_TTL, SCAN_DOWN_TTL)
+
+def scan_parameters(data):
+    # (network, ports, enrich) from a scan request; raises ValueError with a user-facing message.
+    if data.get('network'):
+        try: network = ipaddress.ip_network(str(data['network']).strip(), strict=False)
+        except ValueError: raise ValueError("Invalid network.")
+    else:
+        try: network = local_network()
+        except OSError: raise ValueError("Could not determine local network.")
+    if network.num_addresses > SCAN_MAX_HOSTS: raise ValueError(f"Network too large (max {SCAN_MAX_HOSTS} addresses).")
+    ports = data.get('ports') or SCAN_PORTS
+    try: ports = list(dict.fromkeys(int(port) for port in ports))
+    except (TypeError, ValueError): raise ValueError("Invalid port list.")
+    if not 0 < len(ports) <= 16 or not all(0 < port < 65536 for port in ports): raise ValueError("Invalid port list.")
+    return network, ports, data.get('vendor', True) is not False
+
+# --- Screenshots ---
+# `screencap -p` runs through an exec: service, which is binary-safe, so the PNG comes back in the
+# same round trip instead of screencap -> pull -> rm through /sdcard. Recent captures keep a small
+# thumbnail in memory (when Pillow is installed) for the panel's gallery.
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+class ExecSource:
+    # Output of an exec: service on the adb server, or `adb exec-out` as a fallback. On the socket the
+    # timeout bounds each read; for the fallback it bounds the whole command unless watchdog=False.
+    def __init__(self, device_id, command, timeout, watchdog=True):
+        self.sock = self.process = self._watchdog = None
+        self.call = metrics.start(["adb", "-s", device_id, "exec-out", command], 'server' if USE_ADB_SERVER else 'cli')
+        try:
+            if USE_ADB_SERVER:
+                try: self.sock = adb_server.open_service(device_id, f'exec:{command}', timeout)
+                except OSError: self.call.via('cli')
+            if not self.sock:
+                self.process = subprocess.Popen(
+                    ["adb", "-s", device_id, "exec-out", command], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                    startupinfo=hidden_startupinfo(), start_new_session=os.name != 'nt'
+                )
+                if watchdog:
+                    self._watchdog = threading.Timer(timeout, terminate_process, (self.process, True))
+                    self._watchdog.start()
+        except BaseException:
+            self.call.close()
+            raise
+
+    def chunks(self, size=UPLOAD_CHUNK_SIZE):
+        # The transfer counts as ok only when it is read to the end (and the exec-out child exits cleanly).
+        try:
+            if self.sock:
+                yield from iter(lambda: self.sock.recv(size), b'')
+                self.call.finish(True, None)
+            else:
+                yield from iter(lambda: self.process.stdout.read1(size), b'')
+                self.call.finish(self.process.wait() == 0, None)
+        except socket.timeout:
+            self.call.finish(False, None, timed_out=True)
+            raise
+        finally:
+            self.close()
+
+    def close(self, outcome='failed'):
+        # May be called from another thread; shutdown() wakes a recv() blocked on the socket.
+        if self.sock:
+            try: self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+            self.sock.close()
+        else:
+            terminate_process(self.process, kill=True)
+            self.process.wait()
+            if self._watchdog: self._watchdog.cancel()
+        self.call.close(outcome)
+
+def screenshot_chunks(device_id, timeout=30):
+    # Returns (success, chunk iterator) once the first bytes are known to be a PNG, else (False, message).
+    try:
+        source = ExecSource(device_id, "screencap -p", timeout)
+        chunks = source.chunks()
+        first = b''
+        for chunk in chunks:
+            first += chunk
+            if len(first) >= len(PNG_SIGNATURE): break
+    except (OSError, AdbServerError) as e: return False, f"Screenshot failed: {e}"
+    if not first.startswith(PNG_SIGNATURE):
+        chunks.close()
+        return False, f"Screenshot failed: {first.decode('utf-8', 'ignore').strip() or 'no image returned'}"
+
+    def stream():
+        yield first
+        yield from chunks
+    return True, stream()
+
+def screenshot_name(device_id, suffix=''):
+    return f"screenshot_{secure_filename(device_id.replace(':', '_'))}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}{suffix}.png"
+
+def save_screenshot(device_id, path, timeout=30):
+    # Streams one capture to `path`; returns (success, message).
+    success, chunks = screenshot_chunks(device_id, timeout)
+    if not success: return False, chunks
+    try:
+        with open(path, 'wb') as f:
+            for chunk in chunks: f.write(chunk)
+    except (OSError, AdbServerError) as e:
+        if os.path.exists(path): os.remove(path)
+        return False, f"Screenshot failed: {e}"
+    screenshot_thumbnails.add(path, device_id)
+    return True, f"Screenshot saved to '{os.path.basename(os.path.dirname(path))}'."
+
+class ThumbnailCache:
+    def __init__(self, capacity, size):
+        self.capacity = capacity
+        self.size = size
+        self._entries = OrderedDict() # file name -> entry dict, oldest first
+        self._lock = threading.Lock()
+
+    def add(self, path, device_id):
+        # Entries are keyed by their path under pulled_files, since burst frames share file names.
+        name = os.path.relpath(path, app.config['PULLED_FILES_FOLDER']).replace(os.sep, '/')
+        entry = {"name": name, "device": device_id, "created": time.time(), "size": os.path.getsize(path), "thumbnail": None}
+        if Image is not None:
+            try:
+                with Image.open(path) as image:
+                    image.thumbnail((self.size, self.size))
+                    buffer = io.BytesIO()
+                    image.convert('RGB').save(buffer, 'JPEG', quality=80)
+                    entry["thumbnail"] = buffer.getvalue()
+            except Exception as e: print(f"Could not create thumbnail for {path}: {e}")
+        with self._lock:
+            self._entries[entry["name"]] = entry
+            self._entries.move_to_end(entry["name"])
+            while len(self._entries) > self.capacity: self._entries.popitem(last=False)
+
+    def get(self, name):
+        with self._lock: entry = self._entries.get(name)
+        return entry["thumbnail"] if entry else None
+
+    def list(self):
+        with self._lock:
+            entries = list(reversed(self._entries.values()))
+        return [{**entry, "thumbnail": entry["thumbnail"] is not None} for entry in entries]
+
+screenshot_thumbnails = ThumbnailCache(SCREENSHOT_THUMB_CACHE, SCREENSHOT_THUMB_SIZE)
+
+def screenshot_burst_job(job, device_id, folder, fps, count):
+    # Frames are started on a fixed schedule (index / fps); when the device can't keep up, late frames
+    # start immediately and the achieved rate is reported instead of silently stretching the burst.
+    os.makedirs(folder, exist_ok=True)
+    started = time.monotonic()
+    saved, errors = 0, []
+    with ThreadPoolExecutor(max_workers=SCREENSHOT_BURST_INFLIGHT, thread_name_prefix='burst') as pool:
+        pending = set()
+
+        def collect(done):
+            nonlocal saved
+            for future in done:
+                success, message = future.result()
+                if success: saved += 1
+                else: errors.append(message)
+            job.progress = min((saved + len(errors)) * 100 // count, 99)
+
+        for index in range(count):
+            job.sleep(max(started + index / fps - time.monotonic(), 0))
+            while len(pending) >= SCREENSHOT_BURST_INFLIGHT:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            path = os.path.join(folder, f"frame_{index + 1:04d}.png")
+            pending.add(pool.submit(save_screenshot, device_id, path))
+        collect(wait(pending).done)
+    elapsed = time.monotonic() - started
+    job.result = {"folder": folder, "frames": saved, "failed": len(errors), "fps": round(saved / elapsed, 2) if elapsed else None}
+    message = f"Saved {saved}/{count} frames to '{folder}' ({job.result['fps']} fps, target {fps})."
+    if errors: message += f" Last error: {errors[-1]}"
+    return saved > 0, message
+
+# --- File Browser ---
+# A directory listing is one `stat` over the directory's entries, cached for a few seconds. Downloads
+# stream from the device through exec: (binary-safe) straight into the response, and a Range request
+# becomes a `dd` with skip_bytes/count_bytes, so seeking in a video costs one round trip instead of a
+# full pull. dd seeks its input file to the offset; `tail -c +N` reads through from the start on some
+# toybox builds, which made late seeks in large videos cost almost a full read. A file already pulled to pulled_files/ with the same size and mtime is sent from disk.
+FILE_ENTRY_TYPES = {'directory': 'dir', 'regular file': 'file', 'regular empty file': 'file'}
+FILE_STAT_FORMAT = "'%F|%s|%Y|%a|%n'"
+
+def device_path(path):
+    # Absolute, normalized device path, or None.
+    if not isinstance(path, str) or not path.startswith('/'): return None
+    return '/' + posixpath.normpath(path).lstrip('/')
+
+def parse_file_entries(output):
+    entries = []
+    for line in output.splitlines():
+        parts = line.split('|', 4)
+        if len(parts) != 5 or not parts[1].isdigit(): continue
+        kind, size, mtime, mode, name = parts
+        entries.append({
+            "name": name, "type": FILE_ENTRY_TYPES.get(kind, 'other'), "size": int(size),
+            "mtime": int(mtime) if mtime.isdigit() else None, "mode": mode,
+        })
+    return entries
+
+class FileListCache:
+    def __init__(self, ttl, capacity):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._listings = OrderedDict() # (serial, path) -> (fetched, entries)
+        self._lock = threading.Lock()
+
+    def get(self, serial, path, refresh=False):
+        # Returns (entries, None) or (None, error message).
+        key = (serial, path)
+        with self._lock:
+            cached = self._listings.get(key)
+            if cached and not refresh and time.monotonic() - cached[0] < self.ttl:
+                self._listings.move_to_end(key)
+                return cached[1], None
+        # Symlinks are followed (-L) so linked folders such as /sdcard are browsable; broken ones drop out.
+        script = f"cd {shlex.quote(path)} || exit 1; stat -L -c {FILE_STAT_FORMAT} -- * .[!.]* ..?* 2>/dev/null; true"
+        success, output = run_command(["adb", "-s", serial, "shell", script])
+        if not success: return None, output or f"Cannot list {path}."
+        entries = sorted(parse_file_entries(output), key=lambda entry: (entry["type"] != 'dir', entry["name"].casefold()))
+        with self._lock:
+            self._listings[key] = (time.monotonic(), entries)
+            self._listings.move_to_end(key)
+            while len(self._listings) > self.capacity: self._listings.popitem(last=False)
+        return entries, None
+
+    def stat(self, serial, path):
+        # A fresh cached listing of the parent answers without a device round trip.
+        directory, name = posixpath.split(path)
+        with self._lock: cached = self._listings.get((serial, directory))
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            entry = next((entry for entry in cached[1] if entry["name"] == name), None)
+            if entry: return entry, None
+        success, output = run_command(["adb", "-s", serial, "shell", f"stat -L -c {FILE_STAT_FORMAT} -- {shlex.quote(path)}"])
+        entries = parse_file_entries(output) if success else []
+        if not entries: return None, output or f"{path} not found."
+        return {**entries[0], "name": name}, None
+
+    def invalidate(self, serial, path=None):
+        with self._lock:
+            for key in [key for key in self._listings if key[0] == serial and path in (None, key[1])]: del self._listings[key]
+
+file_listings = FileListCache(FILE_LIST_TTL, FILE_LIST_CACHE)
+
+# <video src> and download links cannot send headers, and a key in the query string would end up in
+# logs, browser history and Referer headers. So these links carry ?token=<expiry>.<HMAC of the route,
+# file, device and expiry>, which opens that one file until it expires and nothing else.
+def media_signature(endpoint, path, serial, expires):
+    message = '\n'.join((endpoint, path, serial, str(expires))).encode('utf-8')
+    return hmac.new(API_SECRET_KEY.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+def media_token(endpoint, path, serial=''):
+    expires = int(time.time()) + MEDIA_LINK_TTL
+    return f"{expires}.{media_signature(endpoint, path, serial, expires)}"
+
+def has_media_token(req, path, serial=''):
+    expires, _, signature = req.args.get('token', '').partition('.')
+    if not expires.isdigit() or int(expires) < time.time(): return False
+    return hmac.compare_digest(signature.encode('utf-8'), media_signature(req.endpoint, path, serial, int(expires)).encode('utf-8'))
+
+def file_download_url(device_id, path):
+    path = device_path(path)
+    return f"/files/download?{urlencode({'path': path, 'serial': device_id, 'token': media_token('download_file', path, device_id)})}"
+
+def local_file_url(name):
+    return f"/files/local/{quote(name)}?token={media_token('local_file', name)}"
+
+def backup_download_url(backup_id):
+    return f"/backups/{quote(backup_id)}/download?token={media_token('download_backup', backup_id)}"
+
+def content_disposition(name, attachment=False):
+    return f"{'attachment' if attachment else 'inline'}; filename*=UTF-8''{quote(name)}"
+
+# --- Mirror Sessions ---
+# Every scrcpy child is a session keyed by (device, kind), so several devices can mirror or record
+# at once. Each session is charged its preset's cost against SCRCPY_CPU_BUDGET (about one unit per
+# full-quality stream the host can decode/encode); a new session gets the best preset that still
+# fits and is refused once even the cheapest one would oversubscribe the host. A watcher thread per
+# session drains scrcpy's log and reaps the child the moment it exits, crashed or not.
+SCRCPY_PRESETS = OrderedDict([
+    ('high', {"bit_rate": "8M", "max_size": 1280, "max_fps": None, "cost": 1.0}),
+    ('medium', {"bit_rate": "4M", "max_size": 1024, "max_fps": 30, "cost": 0.5}),
+    ('low', {"bit_rate": "2M", "max_size": 720, "max_fps": 24, "cost": 0.25}),
+])
+SESSION_KINDS = ('mirror', 'recording')
+SESSION_OUTPUT_LINES = 40
+
+def scrcpy_command(device_id, kind, preset, path=None):
+    settings = SCRCPY_PRESETS[preset]
+    command = ["scrcpy", "--serial", device_id, "--no-audio", "--video-bit-rate", settings["bit_rate"], "--max-size", str(settings["max_size"])]
+    if settings["max_fps"]: command += ["--max-fps", str(settings["max_fps"])]
+    if kind == 'recording': return command + ["--record", path, "--window-title", f"RECORDING - {device_id}"]
+    return command + ["--window-title", f"Mirroring {device_id}"]
+
+def recording_path(device_id):
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    return os.path.join(app.config['RECORDINGS_FOLDER'], f"recording_{timestamp}_{secure_filename(device_id.replace(':', '_'))}.mp4")
+
+class MirrorSession:
+    def __init__(self, device_id, kind, preset, path=None):
+        self.id = uuid.uuid4().hex[:8]
+        self.device_id = device_id
+        self.kind = kind
+        self.preset = preset
+        self.cost = SCRCPY_PRESETS[preset]["cost"]
+        self.path = path
+        self.command = scrcpy_command(device_id, kind, preset, path)
+        self.status = 'running'
+        self.returncode = None
+        self.started = time.time()
+        self.ended = None
+        self.output = deque(maxlen=SESSION_OUTPUT_LINES)
+        self.process = self.call = None
+
+    def to_dict(self):
+        return {
+            "id": self.id, "device": self.device_id, "kind": self.kind, "preset": self.preset, "cost": self.cost,
+            "file": self.path, "status": self.status, "returncode": self.returncode, "pid": self.process.pid if self.process else None,
+            "started": self.started, "ended": self.ended, "output": list(self.output) if self.status == 'crashed' else [],
+        }
+
+class SessionSupervisor:
+    def __init__(self, budget, history, stop_timeout):
+        self.budget = budget
+        self.history = history
+        self.stop_timeout = stop_timeout
+        self._sessions = OrderedDict() # id -> session, running and recently ended
+        self._active = {} # (device, kind) -> running session
+        self._lock = threading.Lock()
+
+    def _used(self):
+        return sum(session.cost for session in self._active.values())
+
+    def usage(self):
+        with self._lock: used = self._used()
+        return {"budget": self.budget, "used": round(used, 2), "free": round(max(self.budget - used, 0), 2)}
+
+    def start(self, device_id, kind, preset=None):
+        # Returns (session, None) or (None, (message, http status)).
+        with self._lock:
+            existing = self._active.get((device_id, kind))
+            if existing: return None, (f"{device_id} already has a {kind} session ({existing.id}).", 409)
+            free = self.budget - self._used()
+            fitting = [name for name, settings in SCRCPY_PRESETS.items() if settings["cost"] <= free + 1e-9]
+            if preset and preset not in fitting:
+                return None, (f"Not enough CPU budget for the {preset} preset ({free:.2f} of {self.budget:g} left).", 503)
+            if not fitting:
+                return None, (f"CPU budget exhausted: {len(self._active)} sessions are using {self._used():.2f} of {self.budget:g}. Stop one first.", 503)
+            session = MirrorSession(device_id, kind, preset or fitting[0], recording_path(device_id) if kind == 'recording' else None)
+            session.call = metrics.start(session.command, slow=False)
+            try:
+                session.process = subprocess.Popen(
+                    session.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=os.name != 'nt'
+                )
+            except Exception as e:
+                session.call.close()
+                return None, (f"An error occurred: {e}", 500)
+            self._active[(device_id, kind)] = session
+            self._sessions[session.id] = session
+            ended = [session_id for session_id, old in self._sessions.items() if old.ended]
+            for session_id in ended[:max(len(ended) - self.history, 0)]: del self._sessions[session_id]
+        threading.Thread(target=self._watch, args=(session,), name=f'scrcpy-{session.id}', daemon=True).start()
+        return session, None
+
+    def _watch(self, session):
+        for line in iter(session.process.stdout.readline, b''):
+            session.output.append(line.decode('utf-8', 'ignore').rstrip())
+        returncode = session.process.wait()
+        with self._lock:
+            session.returncode, session.ended = returncode, time.time()
+            if session.status == 'stopping': session.status = 'stopped'
+            else: session.status = 'exited' if returncode == 0 else 'crashed'
+            session.call.close({'stopped': 'cancelled', 'exited': 'ok'}.get(session.status, 'failed'))
+            if self._active.get((session.device_id, session.kind)) is session: del self._active[(session.device_id, session.kind)]
+
+    def get(self, session_id):
+        return self._sessions.get(session_id)
+
+    def list(self):
+        with self._lock: return [session.to_dict() for session in reversed(self._sessions.values())]
+
+    def stop(self, session):
+        # scrcpy finalizes a recording on SIGTERM; it is killed if it has not exited after stop_timeout.
+        with self._lock:
+            if session.ended or session.status == 'stopping': return False
+            session.status = 'stopping'
+        terminate_process(session.process)
+        deadline = threading.Timer(self.stop_timeout, terminate_process, (session.process, True))
+        deadline.daemon = True
+        deadline.start()
+        return True
+
+    def stop_matching(self, device_id=None, kind=None):
+        with self._lock:
+            sessions = [session for (serial, session_kind), session in self._active.items() if device_id in (None, serial) and kind in (None, session_kind)]
+        return [session for session in sessions if self.stop(session)]
+
+mirror_sessions = SessionSupervisor(SCRCPY_CPU_BUDGET, SCRCPY_SESSION_HISTORY, SCRCPY_STOP_TIMEOUT)
+
+def start_sessions(kind):
+    data = request.get_json(silent=True) or {}
+    preset = data.get('preset') or None
+    if preset is not None and preset not in SCRCPY_PRESETS:
+        return jsonify({"error": f"Unknown preset. Use one of: {', '.join(SCRCPY_PRESETS)}."}), 400
+    targets = requested_targets()
+    if targets is not None:
+        serials, results = targets
+        for serial in serials:
+            session, error = mirror_sessions.start(serial, kind, preset)
+            results[serial] = {"status": "success", "session": session.to_dict()} if session else {"status": "error", "message": error[0]}
+        return fan_out_response(results, **mirror_sessions.usage())
+    device_id = get_connected_device()
+    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
+    session, error = mirror_sessions.start(device_id, kind, preset)
+    if error: return jsonify({"status": "error", "message": error[0]}), error[1]
+    message = "Mirroring started!" if kind == 'mirror' else f"Recording started! Saving to {session.path}"
+    return jsonify({"status": "success", "message": f"{message} ({session.preset} quality)", "session": session.to_dict(), **mirror_sessions.usage()})
+
+# --- Backup Store ---
+# `bu backup` (what `adb backup` runs) streams over an exec: service. A reader thread keeps pulling
+# from the device while the job thread cuts the stream into content-defined chunks, so a repeat
+# backup reuses every chunk that did not change. Finding cut points and compressing new chunks runs
+# in a process pool; only hashing and bookkeeping happen here. A compressed .ab payload is a single
+# zlib stream, where one changed byte shifts everything after it, so it is inflated before chunking
+# and deflated again when the .ab is rebuilt for restore or download.
+BACKUP_MAGIC = b'ANDROID BACKUP'
+BACKUP_HEADER_LINES = 4 # magic, format version, compressed flag, encryption
+_backup_pool = _backup_store = None
+_backup_lock = threading.Lock()
+
+def backup_pool():
+    # Workers come from a fork server (spawned one by one on Windows), never forked from this process
+    # while its registry, job and telemetry threads might hold a lock. Either way app.py is imported
+    # again as __mp_main__ (once in the fork server, or in every spawned worker); that only defines
+    # things, since the panel itself starts under `if __name__ == '__main__'`.
+    global _backup_pool
+    with _backup_lock:
+        if _backup_pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _backup_pool = ProcessPoolExecutor(max_workers=BACKUP_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _backup_pool
+
+def backup_store():
+    global _backup_store
+    root = os.path.join(BACKUP_BASE_DRIVE, 'NexusPanel_Backups', 'store')
+    with _backup_lock:
+        if _backup_store is None or _backup_store.root != root: _backup_store = ChunkStore(root)
+        return _backup_store
+
+def split_backup_header(data):
+    # Returns (header, payload), or None while the header is still incomplete.
+    lines = data.split(b'\n', BACKUP_HEADER_LINES)
+    if len(lines) <= BACKUP_HEADER_LINES:
+        if len(data) > 1024: raise ValueError("malformed backup header")
+        return None
+    if lines[0] != BACKUP_MAGIC: raise ValueError(data.decode('utf-8', 'ignore').strip()[:200])
+    return data[:len(data) - len(lines[-1])], lines[-1]
+
+def backup_reader(source, chunk_queue, stop):
+    # Ends with None, or the exception that broke the transfer.
+    def put(item):
+        while not stop.is_set():
+            try: return chunk_queue.put(item, timeout=1)
+            except queue.Full: pass
+    try:
+        for chunk in source.chunks():
+            put(chunk)
+            if stop.is_set(): return
+        put(None)
+    except Exception as e: put(e)
+
+def backup_store_job(job, device_id, backup_id):
+    store, pool = backup_store(), backup_pool()
+    try: source = ExecSource(device_id, "bu backup -all", BACKUP_STALL_TIMEOUT, watchdog=False)
+    except (OSError, AdbServerError) as e: return False, f"Backup failed: {e}"
+    chunk_queue, stop = queue.Queue(maxsize=max(BACKUP_READ_AHEAD // UPLOAD_CHUNK_SIZE, 1)), threading.Event()
+    threading.Thread(target=backup_reader, args=(source, chunk_queue, stop), name='backup-reader', daemon=True).start()
+    chunker = Chunker(pool, BACKUP_MIN_CHUNK, BACKUP_MAX_CHUNK, BACKUP_SEGMENT_SIZE, BACKUP_WORKERS * 2)
+    writer = ChunkWriter(store, pool, BACKUP_COMPRESS_LEVEL, BACKUP_SEGMENT_SIZE, BACKUP_WORKERS * 2)
+    pending, header, inflater, received, size, saved = b'', None, None, 0, 0, False
+    job.result = {"id": backup_id, "received": 0}
+    try:
+        idle_since = time.monotonic()
+        while True:
+            job.check_cancelled()
+            try: data = chunk_queue.get(timeout=1)
+            except queue.Empty:
+                if time.monotonic() - idle_since < BACKUP_STALL_TIMEOUT: continue
+                return False, f"Backup failed: the device sent nothing for {BACKUP_STALL_TIMEOUT} seconds."
+            if isinstance(data, Exception): return False, f"Backup failed: {data}"
+            if data is None: break
+            idle_since = time.monotonic()
+            received += len(data)
+            job.result["received"] = received
+            if header is None:
+                try: split = split_backup_header(pending + data)
+                except ValueError as e: return False, f"Backup failed: {e}"
+                if split is None:
+                    pending += data
+                    continue
+                header, data = split
+                _, _, compressed, encryption = header.decode('utf-8', 'ignore').split('\n')[:BACKUP_HEADER_LINES]
+                if compressed == '1' and encryption == 'none': inflater = zlib.decompressobj()
+            if inflater:
+                try: data = inflater.decompress(data)
+                except zlib.error as e: return False, f"Backup failed: corrupt compressed data ({e})."
+                if inflater.unused_data: return False, "Backup failed: unexpected data after the compressed stream."
+            size += len(data)
+            for chunk in chunker.feed(data): writer.add(chunk)
+        if header is None: return False, f"Backup failed: {pending.decode('utf-8', 'ignore').strip()}" if pending.strip() else "Backup was cancelled or failed on the device."
+        if inflater and not inflater.eof: return False, "Backup failed: the device stopped before the backup was complete."
+        for chunk in chunker.finish(): writer.add(chunk)
+        writer.close()
+        manifest = {
+            "id": backup_id, "device": device_id, "created": time.time(), "header": header.decode('utf-8'),
+            "inflated": inflater is not None, "received": received, "size": size, "new_chunks": writer.new_chunks,
+            "new_bytes": writer.new_bytes, "chunks": writer.digests,
+        }
+        store.save_manifest(manifest)
+        saved = True
+    except JobCancelled:
+        source.close('cancelled')
+        raise
+    finally:
+        stop.set()
+        source.close()
+        if not saved:
+            writer.abort()
+            store.sweep() # drops chunks only this backup had written
+    store.release(writer)
+    job.result = {**{key: value for key, value in manifest.items() if key != 'chunks'}, "chunks": len(writer.digests), "store": store.stats()}
+    return True, f"Backup {backup_id} finished: {received} bytes received, {writer.new_bytes} new bytes stored."
+
+def restore_job(job, device_id, manifest):
+    # `bu restore` is what `adb restore` runs; the .ab is rebuilt on the fly and never written to disk.
+    total = len(manifest["header"].encode('utf-8')) + manifest["size"] if not manifest["inflated"] else None
+    try: success, output, written, _ = stream_to_device(job, device_id, "bu restore", restore_stream(backup_store(), manifest, BACKUP_COMPRESS_LEVEL), total)
+    except ChunkStoreError as e: return False, f"Restore failed: {e}"
+    job.result = {"id": manifest["id"], "bytes": written}
+    if success: return True, f"Restore of {manifest['id']} finished."
+    return False, f"Restore failed: {output or 'the device rejected the backup.'}"
+
+# --- Device Changes ---
+# Whatever is cached per device is dropped when it connects, disconnects or changes state: a
+# reconnect may be a different build, a reset phone or another device behind the same address.
+def _on_device_change(serial, old, new):
+    if new and old and new['state'] == old['state']: return
+    adb_server.forget(serial)
+    device_info_cache.invalidate(serial)
+    package_catalog.invalidate(serial)
+    forget_installed_apks(serial)
+    file_listings.invalidate(serial)
+
+device_registry.on_change(_on_device_change)
+
 # --- Main App Routes ---
 @app.route('/')
 def index(): return render_template('index.html')
 
 # --- Backup & Media Routes ---
+def backup_job(job, device_id, pc_path):
+    command = ["adb", "-s", device_id, "backup", "-all", "-f", pc_path]
+    success, output = job.run(command, timeout=3600) # 1 hour timeout
+    if success:
+        job.result = {"path": pc_path}
+        return True, f"Backup process finished. File saved to {pc_path}"
+    if os.path.exists(pc_path) and os.path.getsize(pc_path) == 0:
+        os.remove(pc_path)
+        return False, "Backup was cancelled or failed on the device."
+    return False, f"Backup failed: {output}"
+
 @app.route('/backup_device', methods=['POST'])
 def backup_device():
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
     device_id = get_connected_device()
     if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
 
+    if BACKUP_STORE and (request.get_json(silent=True) or {}).get('format') != 'ab':
+        backup_id = new_backup_id(device_id)
+        job = jobs.submit('backup', device_id, f"Full backup {backup_id}", backup_store_job, device_id, backup_id)
+        return job_started(job, "Backup started. Confirm it on your phone's screen.")
+
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
     backup_folder = os.path.join(BACKUP_BASE_DRIVE, 'NexusPanel_Backups')
     filename = f"full_backup_{timestamp}.ab"
     pc_path = os.path.join(backup_folder, filename)
 
-    command = ["adb", "-s", device_id, "backup", "-all", "-f", pc_path]
-    success, output = run_command(command, timeout=3600) # 1 hour timeout
+    job = jobs.submit('backup', device_id, f"Full backup to {filename}", backup_job, device_id, pc_path)
+    return job_started(job, "Backup started. Confirm it on your phone's screen.")
+
+@app.route('/backups', methods=['POST'])
+def list_backups():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    store = backup_store()
+    backups = [{**manifest, "url": backup_download_url(manifest["id"])} for manifest in store.manifests()]
+    return jsonify({"status": "success", "backups": backups, "store": store.stats()})
+
+@app.route('/backups/<backup_id>/restore', methods=['POST'])
+def restore_backup(backup_id):
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    manifest = backup_store().load_manifest(backup_id)
+    if not manifest: return jsonify({"status": "error", "message": "Unknown backup."}), 404
+    device_id = get_connected_device()
+    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
+    job = jobs.submit('restore', device_id, f"Restore {backup_id}", restore_job, device_id, manifest)
+    return job_started(job, "Restore started. Confirm it on your phone's screen.")
+
+@app.route('/backups/<backup_id>/download', methods=['GET'])
+def download_backup(backup_id):
+    # The rebuilt .ab, for `adb restore` on another machine; the signed link comes from /backups.
+    if not has_media_token(request, backup_id): return jsonify({"error": "Unauthorized"}), 401
+    store = backup_store()
+    manifest = store.load_manifest(backup_id)
+    if not manifest: return jsonify({"status": "error", "message": "Unknown backup."}), 404
+    headers = {"Content-Disposition": content_disposition(f"{manifest['id']}.ab", attachment=True)}
+    if not manifest["inflated"]: headers["Content-Length"] = str(len(manifest["header"].encode('utf-8')) + manifest["size"])
+    return Response(restore_stream(store, manifest, BACKUP_COMPRESS_LEVEL), mimetype='application/octet-stream', headers=headers)
 
+@app.route('/backups/<backup_id>/delete', methods=['POST'])
+def delete_backup(backup_id):
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    store = backup_store()
+    if not store.delete(backup_id): return jsonify({"status": "error", "message": "Unknown backup."}), 404
+    chunks, freed = store.sweep()
+    return jsonify({"status": "success", "message": f"Deleted {backup_id}; freed {freed} bytes in {chunks} chunks.", "store": store.stats()})
+
+def download_photos_job(job, device_id, phone_camera_path, pc_folder_path):
+    remote, _ = list_remote_files(device_id, phone_camera_path)
+    progress = local_progress(pc_folder_path, sum(info["size"] for info in (remote or {}).values()))
+    command = ["adb", "-s", device_id, "pull", phone_camera_path, pc_folder_path]
+    success, output = job.run(command, timeout=1800, progress=progress) # 30 minute timeout
     if success:
-        return jsonify({"status": "success", "message": f"Backup process finished. File saved to {pc_path}"})
-    else:
-        if os.path.exists(pc_path) and os.path.getsize(pc_path) == 0:
-            os.remove(pc_path)
-            return jsonify({"status": "error", "message": "Backup was cancelled or failed on the device."})
-        return jsonify({"status": "error", "message": f"Backup failed: {output}"})
+        files_pulled = len(os.listdir(pc_folder_path))
+        job.result = {"path": pc_folder_path, "files": files_pulled}
+        return True, f"Successfully pulled {files_pulled} items to {pc_folder_path}"
+    return False, f"Failed to download photos: {output}"
+
+# --- Incremental Photo Sync ---
+# Each device gets one stable destination tree plus a manifest of what was pulled (size, mtime,
+# optional md5). A sync lists the camera folder with a single find/stat call, diffs it against the
+# manifest and only pulls new or changed files, several at a time.
+PHOTO_MANIFEST_NAME = '.nexus_manifest.json'
+
+def photo_sync_root(device_id):
+    return os.path.join(BACKUP_BASE_DRIVE, 'NexusPanel_Photos', secure_filename(device_id.replace(':', '_')))
+
+def load_photo_manifest(path):
+    try:
+        with open(path, encoding='utf-8') as f: return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}}
+
+def save_photo_manifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def list_remote_files(device_id, remote_root):
+    success, output = run_command(["adb", "-s", device_id, "shell", f"find {shlex.quote(remote_root)} -type f -exec stat -c '%s %Y %n' {{}} +"], timeout=120)
+    if not success and not output.strip(): return None, output
+    files = {}
+    for line in output.splitlines():
+        parts = line.split(' ', 2)
+        if len(parts) != 3 or not parts[0].isdigit() or not parts[2].startswith(remote_root): continue
+        files[parts[2][len(remote_root):]] = {"size": int(parts[0]), "mtime": int(parts[1])}
+    if not files and not success: return None, output
+    return files, output
+
+def remote_md5sums(device_id, paths):
+    sums = {}
+    for i in range(0, len(paths), 100):
+        batch = ' '.join(shlex.quote(path) for path in paths[i:i + 100])
+        _, output = run_command(["adb", "-s", device_id, "shell", f"md5sum {batch}"], timeout=120)
+        for line in output.splitlines():
+            digest, _, path = line.partition('  ')
+            if len(digest) == 32: sums[path] = digest
+    return sums
+
+def local_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''): digest.update(block)
+    return digest.hexdigest()
+
+def photo_sync_job(job, device_id, remote_root):
+    dest_root = photo_sync_root(device_id)
+    dest_dir = os.path.join(dest_root, 'Camera')
+    manifest_path = os.path.join(dest_root, PHOTO_MANIFEST_NAME)
+    os.makedirs(dest_dir, exist_ok=True)
+    manifest = load_photo_manifest(manifest_path)
+    known = manifest.setdefault("files", {})
+
+    remote, output = list_remote_files(device_id, remote_root)
+    if remote is None: return False, f"Failed to list photos: {output}"
+
+    def local_path(rel):
+        return os.path.join(dest_dir, *rel.split('/'))
+
+    def unchanged(rel, info):
+        entry = known.get(rel)
+        path = local_path(rel)
+        return entry and entry["size"] == info["size"] and os.path.exists(path) and os.path.getsize(path) == info["size"]
+
+    changed = [rel for rel, info in remote.items() if not unchanged(rel, info) or known[rel]["mtime"] != info["mtime"]]
+    if PHOTO_SYNC_HASH:
+        # Same size but a new mtime: re-pull only if the content really differs.
+        touched = [rel for rel in changed if unchanged(rel, remote[rel]) and known[rel].get("md5")]
+        sums = remote_md5sums(device_id, [remote_root + rel for rel in touched])
+        for rel in touched:
+            if sums.get(remote_root + rel) == known[rel]["md5"]:
+                known[rel]["mtime"] = remote[rel]["mtime"]
+                changed.remove(rel)
+
+    total, done, failed = len(changed), 0, []
+    lock = threading.Lock()
+    job.result = {"path": dest_dir, "remote_files": len(remote), "to_pull": total, "pulled": 0}
+
+    def pull(rel):
+        # Through job.run, so cancelling the job kills the pulls in flight; a partial file never survives.
+        path = local_path(rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            success, output = job.run(["adb", "-s", device_id, "pull", "-a", remote_root + rel, path + '.part'], timeout=1800)
+            if success: os.replace(path + '.part', path)
+            return success, output
+        finally:
+            if os.path.exists(path + '.part'): os.remove(path + '.part')
+
+    with ThreadPoolExecutor(max_workers=PHOTO_SYNC_WORKERS) as pool:
+        futures = {pool.submit(pull, rel): rel for rel in changed}
+        try:
+            for future in futures:
+                rel = futures[future]
+                try: success, output = future.result()
+                except JobCancelled: continue
+                with lock:
+                    done += 1
+                    if success:
+                        entry = dict(remote[rel])
+                        if PHOTO_SYNC_HASH: entry["md5"] = local_md5(local_path(rel))
+                        known[rel] = entry
+                    else:
+                        failed.append(f"{rel}: {output}")
+                    job.progress = done * 100 // total
+                    job.result["pulled"] = done - len(failed)
+                    if done % 50 == 0: save_photo_manifest(manifest_path, manifest)
+        finally:
+            manifest["remote_root"] = remote_root
+            save_photo_manifest(manifest_path, manifest)
+    job.check_cancelled()
+
+    job.result["failed"] = failed[:20]
+    if failed: return False, f"Synced {total - len(failed)} of {total} new/changed items to {dest_dir}; {len(failed)} failed."
+    if not total: return True, f"Already up to date ({len(remote)} items in {dest_dir})."
+    return True, f"Synced {total} new/changed items to {dest_dir} ({len(remote)} total)."
 
 @app.route('/download_photos', methods=['POST'])
 def download_photos():
@@ -91,20 +2511,94 @@ def download_photos():
     device_id = get_connected_device()
     if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
 
+    phone_camera_path = "/sdcard/DCIM/Camera/"
+    if (request.get_json(silent=True) or {}).get('mode', 'sync') == 'sync':
+        job = jobs.submit('photo_sync', device_id, f"Sync {phone_camera_path}", photo_sync_job, device_id, phone_camera_path)
+        return job_started(job, "Photo sync started.")
+
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
     pc_folder_path = os.path.join(BACKUP_BASE_DRIVE, 'NexusPanel_Photos', f"Photos_{timestamp}")
     os.makedirs(pc_folder_path, exist_ok=True)
 
-    phone_camera_path = "/sdcard/DCIM/Camera/"
-    
-    command = ["adb", "-s", device_id, "pull", phone_camera_path, pc_folder_path]
-    success, output = run_command(command, timeout=1800) # 30 minute timeout
+    job = jobs.submit('download_photos', device_id, f"Pull {phone_camera_path}", download_photos_job, device_id, phone_camera_path, pc_folder_path)
+    return job_started(job, "Photo download started.")
 
-    if success:
-        files_pulled = len(os.listdir(pc_folder_path))
-        return jsonify({"status": "success", "message": f"Successfully pulled {files_pulled} items to {pc_folder_path}"})
-    return jsonify({"status": "error", "message": f"Failed to download photos: {output}"})
+# --- Job Routes ---
+@app.route('/jobs', methods=['POST'])
+def list_jobs():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"status": "success", "jobs": jobs.list()})
+
+@app.route('/jobs/<job_id>', methods=['GET', 'POST'])
+def get_job(job_id):
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    job = jobs.get(job_id)
+    if not job: return jsonify({"status": "error", "message": "Unknown job."}), 404
+    return jsonify({"status": "success", "job": job.to_dict()})
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    job = jobs.get(job_id)
+    if not job: return jsonify({"status": "error", "message": "Unknown job."}), 404
+    if job.done: return jsonify({"status": "error", "message": f"Job already {job.status}."}), 400
+    job.cancel()
+    return jsonify({"status": "success", "message": "Cancellation requested."})
+
+# --- Telemetry Routes ---
+@app.route('/telemetry/start', methods=['POST'])
+def start_telemetry():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    targets = data.get('targets')
+    if isinstance(targets, str): targets = None if targets.strip() == 'all' else [serial.strip() for serial in targets.split(',') if serial.strip()]
+    try:
+        telemetry_sampler.start(interval=data.get('interval'), targets=targets or None)
+    except (TypeError, ValueError): return jsonify({"error": "Invalid interval."}), 400
+    return jsonify({"status": "success", "message": "Telemetry sampler started.", "sampler": telemetry_sampler.status()})
+
+@app.route('/telemetry/stop', methods=['POST'])
+def stop_telemetry():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    telemetry_sampler.stop()
+    return jsonify({"status": "success", "message": "Telemetry sampler stopped.", "sampler": telemetry_sampler.status()})
 
+@app.route('/telemetry', methods=['POST'])
+def get_telemetry():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    # Recorded history outlives the connection (e.g. after a thermal shutdown), so a named device is
+    # looked up whether or not it is still attached.
+    device_id = data.get('serial') or request.headers.get("X-Device-Serial") or get_connected_device()
+    if not device_id: return jsonify({"error": "No device connected."}), 400
+    try:
+        end = float(data.get('end') or time.time())
+        start = float(data.get('start') or end - float(data.get('window', 3600)))
+        buckets = min(max(int(data.get('buckets', 120)), 1), 2000)
+    except (TypeError, ValueError): return jsonify({"error": "Invalid time window."}), 400
+    if start >= end: return jsonify({"error": "Invalid time window."}), 400
+    telemetry = telemetry_sampler.device(device_id)
+    if not telemetry:
+        return jsonify({"status": "error", "message": "No telemetry recorded for this device yet.", "sampler": telemetry_sampler.status()}), 404
+    result = telemetry.query(start, end, buckets, metrics=data.get('metrics'), processes=data.get('processes'))
+    return jsonify({"status": "success", "device": device_id, "start": start, "end": end, "buckets": buckets, **result, "sampler": telemetry_sampler.status()})
+
+# --- Metrics Routes ---
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Prometheus scrapers can send the key as a bearer token (authorization: credentials in the scrape config).
+    if not (is_authorized(request) or request.headers.get('Authorization') == f"Bearer {API_SECRET_KEY}"):
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/slow', methods=['POST'])
+def slow_commands():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    if data.get('threshold') is not None:
+        try: metrics.slow_threshold = max(float(data['threshold']), 0.0)
+        except (TypeError, ValueError): return jsonify({"error": "Invalid threshold."}), 400
+    return jsonify({"status": "success", "threshold": metrics.slow_threshold, "commands": metrics.slow_commands()})
 
 # --- Security & Health Routes ---
 @app.route('/clear_caches', methods=['POST'])
@@ -166,52 +2660,72 @@ def process_manager():
 @app.route('/execute_shell', methods=['POST'])
 def execute_shell():
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
-    device_id = get_connected_device()
-    if not device_id: return jsonify({"error": "No device connected."}), 400
     command_to_run = request.json.get('command')
     if not command_to_run: return jsonify({"error": "No command provided."}), 400
+    targets = requested_targets()
+    if targets is not None:
+        serials, results = targets
+        def run_on(serial):
+            success, output = run_command(["adb", "-s", serial, "shell"] + command_to_run.split(), timeout=60)
+            return {"status": "success" if success else "error", "output": output or "(No output)"}
+        results.update(fan_out(serials, run_on, timeout=60))
+        return fan_out_response(results)
+    device_id = get_connected_device()
+    if not device_id: return jsonify({"error": "No device connected."}), 400
     full_command = ["adb", "-s", device_id, "shell"] + command_to_run.split()
     success, output = run_command(full_command, timeout=60)
     return jsonify({"status": "success", "output": output or "(No output)"})
 
+@app.route('/execute_shell/stream', methods=['POST'])
+def execute_shell_stream():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    device_id = get_connected_device()
+    if not device_id: return jsonify({"error": "No device connected."}), 400
+    command_to_run = request.json.get('command')
+    if not command_to_run: return jsonify({"error": "No command provided."}), 400
+    reap_shell_streams()
+    try:
+        stream = ShellStream(device_id, command_to_run, SHELL_STREAM_BUFFER)
+    except Exception as e: return jsonify({"status": "error", "message": f"An error occurred: {e}"}), 500
+    add_shell_stream(stream)
+    return sse_response(stream.events(0))
+
+@app.route('/shell_streams', methods=['POST'])
+def list_shell_streams():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    reap_shell_streams()
+    with _shell_reaper_lock: streams = list(shell_streams.values())
+    return jsonify({"status": "success", "streams": [stream.to_dict() for stream in streams]})
+
+@app.route('/shell_streams/<stream_id>/events', methods=['GET', 'POST'])
+def shell_stream_events(stream_id):
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    stream = shell_streams.get(stream_id)
+    if not stream: return jsonify({"status": "error", "message": "Unknown stream."}), 404
+    since = request.args.get('since', '')
+    if not since and request.headers.get('Last-Event-ID', '').isdigit():
+        since = str(int(request.headers['Last-Event-ID']) + 1) # resume after the last line the client saw
+    return sse_response(stream.events(int(since) if since.isdigit() else None))
+
+@app.route('/shell_streams/<stream_id>/cancel', methods=['POST'])
+def cancel_shell_stream(stream_id):
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    stream = shell_streams.get(stream_id)
+    if not stream: return jsonify({"status": "error", "message": "Unknown stream."}), 404
+    stream.cancel()
+    return jsonify({"status": "success", "message": "Stream cancelled."})
+
 # --- Other Routes (Info, Actions, etc.) ---
 @app.route('/get_device_info', methods=['POST'])
 def get_device_info():
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
     device_id = get_connected_device()
     if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
-    props = ["ro.product.model", "ro.build.version.release", "ro.serialno"]
-    info = {}
-    for prop in props:
-        _, output = run_command(["adb", "-s", device_id, "shell", "getprop", prop])
-        info[prop] = output
-    _, battery_output = run_command(["adb", "-s", device_id, "shell", "dumpsys", "battery"])
-    level_match = re.search(r'level: (\d+)', battery_output)
-    status_match = re.search(r'status: (\d+)', battery_output)
-    battery_status_codes = {"1": "Unknown", "2": "Charging", "3": "Discharging", "4": "Not charging", "5": "Full"}
-    info['battery_level'] = level_match.group(1) if level_match else "N/A"
-    info['battery_status'] = battery_status_codes.get(status_match.group(1), "N/A") if status_match else "N/A"
-    _, cpu_output = run_command(["adb", "-s", device_id, "shell", "cat", "/proc/cpuinfo"])
-    cpu_model_match = re.search(r'Hardware\s+:\s+(.*)', cpu_output)
-    info['cpu'] = cpu_model_match.group(1).strip() if cpu_model_match else "N/A"
-    _, mem_output = run_command(["adb", "-s", device_id, "shell", "cat", "/proc/meminfo"])
-    mem_total_match = re.search(r'MemTotal:\s+(\d+)\s+kB', mem_output)
-    info['ram'] = f"{int(mem_total_match.group(1)) // 1024} MB" if mem_total_match else "N/A"
-    return jsonify({
-        "status": "success", "model": info.get("ro.product.model"), "android_version": info.get("ro.build.version.release"),
-        "serial": info.get("ro.serialno"), "battery_level": info.get("battery_level"), "battery_status": info.get("battery_status"),
-        "ip_address": device_id, "cpu": info.get("cpu"), "ram": info.get("ram")
-    })
+    info = device_info_cache.get(device_id, refresh=bool((request.get_json(silent=True) or {}).get('refresh')))
+    return jsonify({"status": "success", "ip_address": device_id, **info})
 
-@app.route('/device_action', methods=['POST'])
-def device_action():
-    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
-    device_id = get_connected_device()
-    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
-    
-    data = request.json
-    action = data.get('action')
-    value = data.get('value')
+def perform_device_action(device_id, action, value):
+    # Returns (response payload, HTTP status) for one device.
     cmd = ["adb", "-s", device_id]
     message = f"Action '{action}' executed."
 
@@ -220,14 +2734,10 @@ def device_action():
     if action == 'reboot':
         cmd.append('reboot')
     elif action == 'screenshot':
-        screenshot_name = f"screenshot_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-        phone_path = f"/sdcard/{screenshot_name}"
-        pc_path = os.path.join(app.config['PULLED_FILES_FOLDER'], screenshot_name)
-        run_command(cmd + ["shell", "screencap", phone_path])
-        run_command(cmd + ["pull", phone_path, pc_path])
-        run_command(cmd + ["shell", "rm", phone_path])
-        message = f"Screenshot saved to 'pulled_files'."
-        return jsonify({"status": "success", "message": message})
+        name = screenshot_name(device_id)
+        success, message = save_screenshot(device_id, os.path.join(app.config['PULLED_FILES_FOLDER'], name))
+        if success: return {"status": "success", "message": message, "file": name}, 200
+        return {"status": "error", "message": message}, 500
     elif action == 'open_url':
         target_url = value if value else "https://www.google.com"
         if not target_url.startswith(('http://', 'https://')): target_url = 'https://' + target_url
@@ -245,12 +2755,82 @@ def device_action():
         cmd.extend(['shell', 'am', 'start', '-n', 'com.dev47apps.obsdroidcam/.MainActivity'])
         message = "Launched DroidCam OBS on phone. Now start the PC client."
     else: 
-        return jsonify({"status": "error", "message": "Invalid action received."}), 400
+        return {"status": "error", "message": "Invalid action received."}, 400
 
     success, output = run_command(cmd)
     if success: 
-        return jsonify({"status": "success", "message": message, "output": output})
-    return jsonify({"status": "error", "message": f"Action failed: {output}"}), 500
+        return {"status": "success", "message": message, "output": output}, 200
+    return {"status": "error", "message": f"Action failed: {output}"}, 500
+
+@app.route('/device_action', methods=['POST'])
+def device_action():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    data = request.json
+    action = data.get('action')
+    value = data.get('value')
+    targets = requested_targets()
+    if targets is not None:
+        serials, results = targets
+        results.update(fan_out(serials, lambda serial: perform_device_action(serial, action, value)[0]))
+        return fan_out_response(results)
+    device_id = get_connected_device()
+    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
+    payload, code = perform_device_action(device_id, action, value)
+    return jsonify(payload), code
+
+@app.route('/screenshot', methods=['POST'])
+def screenshot():
+    # Streams the PNG straight from the device into the response; {"save": true} also keeps a copy.
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    device_id = get_connected_device()
+    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
+    success, chunks = screenshot_chunks(device_id)
+    if not success: return jsonify({"status": "error", "message": chunks}), 500
+    name = screenshot_name(device_id)
+    if not (request.get_json(silent=True) or {}).get('save'):
+        return Response(chunks, mimetype='image/png', headers={"Content-Disposition": f'inline; filename="{name}"'})
+    path = os.path.join(app.config['PULLED_FILES_FOLDER'], name)
+
+    def tee():
+        complete = False
+        try:
+            with open(path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            if complete: screenshot_thumbnails.add(path, device_id)
+            elif os.path.exists(path): os.remove(path)
+    return Response(tee(), mimetype='image/png', headers={"Content-Disposition": f'inline; filename="{name}"', "X-Screenshot-File": name})
+
+@app.route('/screenshot_burst', methods=['POST'])
+def screenshot_burst():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    device_id = get_connected_device()
+    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
+    data = request.get_json(silent=True) or {}
+    try:
+        fps = float(data.get('fps', 1))
+        count = int(data['count']) if data.get('count') else int(float(data.get('duration', 10)) * fps)
+    except (TypeError, ValueError): return jsonify({"error": "Invalid fps, count or duration."}), 400
+    if not 0 < fps <= 30 or not 0 < count <= SCREENSHOT_BURST_MAX_FRAMES:
+        return jsonify({"error": f"fps must be in (0, 30] and the burst at most {SCREENSHOT_BURST_MAX_FRAMES} frames."}), 400
+    folder = os.path.join(app.config['PULLED_FILES_FOLDER'], screenshot_name(device_id, '_burst')[:-4])
+    job = jobs.submit('screenshot_burst', device_id, f"{count} screenshots at {fps:g} fps", screenshot_burst_job, device_id, folder, fps, count)
+    return job_started(job, "Screenshot burst started.")
+
+@app.route('/screenshots', methods=['POST'])
+def list_screenshots():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    return jsonify({"status": "success", "thumbnails": Image is not None, "screenshots": screenshot_thumbnails.list()})
+
+@app.route('/screenshots/<path:name>/thumbnail', methods=['GET', 'POST'])
+def screenshot_thumbnail(name):
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    thumbnail = screenshot_thumbnails.get(name)
+    if thumbnail is None: return jsonify({"status": "error", "message": "No thumbnail for that screenshot."}), 404
+    return Response(thumbnail, mimetype='image/jpeg', headers={"Cache-Control": "private, max-age=3600"})
 
 @app.route('/launch_pc_client', methods=['POST'])
 def launch_pc_client():
@@ -279,26 +2859,42 @@ def launch_pc_client():
 @app.route('/scan_network', methods=['POST'])
 def scan_network():
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
-    if nmap is None: return jsonify({"error": "'python-nmap' is not installed."}), 500
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.settimeout(0.1)
-        s.connect(("8.8.8.8", 80))
-        local_ip = s.getsockname()[0]
-        s.close()
-        network_prefix = ".".join(local_ip.split('.')[:-1]) + ".0/24"
-    except Exception: return jsonify({"error": "Could not determine local network."}), 500
-    try:
-        nm = nmap.PortScanner()
-        nm.scan(hosts=network_prefix, arguments='-sn')
-        hosts = []
-        for host_ip in nm.all_hosts():
-            mac_address = nm[host_ip].get('addresses', {}).get('mac', 'N/A')
-            vendor = nm[host_ip]['vendor'].get(mac_address, 'Unknown') if mac_address != 'N/A' else 'N/A'
-            hosts.append({"ip": host_ip, "vendor": vendor})
-        return jsonify({"status": "success", "hosts": hosts})
-    except nmap.nmap.PortScannerError: return jsonify({"error": "Nmap not found."}), 500
+    try: network, ports, enrich = scan_parameters(request.get_json(silent=True) or {})
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    hosts = {}
+    try: summary = lan_scanner.scan(network, ports, lambda host: hosts.__setitem__(host['ip'], host), enrich=enrich)
     except Exception as e: return jsonify({"error": f"Scan error: {e}"}), 500
+    hosts = sorted(hosts.values(), key=lambda host: ipaddress.ip_address(host['ip']))
+    return jsonify({"status": "success", "hosts": hosts, **summary})
+
+@app.route('/scan_network/stream', methods=['POST'])
+def scan_network_stream():
+    # Same scan as /scan_network, delivered as Server-Sent Events: "host" per live host (re-sent
+    # when its vendor is resolved), then "done" with the summary.
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    try: network, ports, enrich = scan_parameters(request.get_json(silent=True) or {})
+    except ValueError as e: return jsonify({"error": str(e)}), 400
+    updates, stop = queue.Queue(), threading.Event()
+
+    def run():
+        try: summary = lan_scanner.scan(network, ports, lambda host: updates.put(('host', host)), stop, enrich)
+        except Exception as e: summary = {"error": f"Scan error: {e}"}
+        updates.put(('done', summary))
+
+    threading.Thread(target=run, name='lan-scan', daemon=True).start()
+
+    def frames():
+        try:
+            yield sse_frame({"network": str(network), "ports": ports}, event='scan')
+            while True:
+                try: event, data = updates.get(timeout=15)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield sse_frame(data, event=event)
+                if event == 'done': return
+        finally: stop.set()
+    return sse_response(frames())
 
 @app.route('/connect', methods=['POST'])
 def connect_device():
@@ -310,55 +2906,67 @@ def connect_device():
         return jsonify({"status": "success", "message": f"Connected to {ip_port}!"})
     return jsonify({"status": "error", "message": message}), 500
 
+@app.route('/devices', methods=['POST'])
+def list_devices():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    if USE_ADB_SERVER: device_registry.start()
+    if USE_ADB_SERVER and device_registry.tracking:
+        return jsonify({"status": "success", "tracking": True, "devices": device_registry.snapshot()})
+    success, output = run_command(["adb", "devices", "-l"])
+    if not success: return jsonify({"status": "error", "message": f"Could not list devices: {output}"}), 500
+    devices = DeviceRegistry.parse('\n'.join(output.split('\n')[1:]))
+    return jsonify({"status": "success", "tracking": False, "devices": list(devices.values())})
+
 @app.route('/start_mirror', methods=['POST'])
 def start_mirror():
-    global active_process
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
-    if active_process and active_process.poll() is None: return jsonify({"status": "error", "message": "Another process is active."}), 400
-    device_id = get_connected_device()
-    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
-    command = ["scrcpy", "--serial", device_id, "--no-audio", "--video-bit-rate", "8M", "--max-size", "1280", "--window-title", f"Mirroring {device_id}"]
-    try:
-        active_process = subprocess.Popen(command)
-        return jsonify({"status": "success", "message": "Mirroring started!"})
-    except Exception as e: return jsonify({"status": "error", "message": f"An error occurred: {e}"}), 500
+    return start_sessions('mirror')
 
 @app.route('/start_recording', methods=['POST'])
 def start_recording():
-    global active_process
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
-    if active_process and active_process.poll() is None: return jsonify({"status": "error", "message": "Another process is active."}), 400
-    device_id = get_connected_device()
-    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    filename = f"recording_{timestamp}.mp4"
-    pc_path = os.path.join(app.config['RECORDINGS_FOLDER'], filename)
-    command = ["scrcpy", "--serial", device_id, "--no-audio", "--record", pc_path, "--window-title", f"RECORDING - {device_id}"]
-    try:
-        active_process = subprocess.Popen(command)
-        return jsonify({"status": "success", "message": f"Recording started! Saving to {pc_path}"})
-    except Exception as e: return jsonify({"status": "error", "message": f"An error occurred: {e}"})
+    return start_sessions('recording')
 
 @app.route('/stop_mirror', methods=['POST'])
 def stop_mirror():
-    
+    # Stops the selected device's sessions (optionally only one "kind"); without X-Device-Serial, all of them.
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind') if data.get('kind') in SESSION_KINDS else None
+    stopped = mirror_sessions.stop_matching(request.headers.get("X-Device-Serial") or None, kind)
+    return jsonify({"status": "success", "message": f"Stopped {len(stopped)} mirror/record process(es).", "stopped": [session.id for session in stopped]})
+
+@app.route('/sessions', methods=['POST'])
+def list_sessions():
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
-    global active_process
-    if active_process:
-        active_process.terminate()
-        active_process = None
-    return jsonify({"status": "success", "message": "Mirror/Record process stopped."})
+    return jsonify({"status": "success", "sessions": mirror_sessions.list(), "presets": SCRCPY_PRESETS, **mirror_sessions.usage()})
+
+@app.route('/sessions/<session_id>/stop', methods=['POST'])
+def stop_session(session_id):
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    session = mirror_sessions.get(session_id)
+    if not session: return jsonify({"status": "error", "message": "Unknown session."}), 404
+    if not mirror_sessions.stop(session): return jsonify({"status": "error", "message": f"Session already {session.status}."}), 400
+    return jsonify({"status": "success", "message": f"Stopping {session.kind} on {session.device_id}.", "session": session.to_dict()})
 
 @app.route('/list_apps', methods=['POST'])
 def list_apps():
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
     device_id = get_connected_device()
     if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
-    success, output = run_command(["adb", "-s", device_id, "shell", "pm", "list", "packages", "-3"])
-    if success:
-        apps = [line.replace('package:', '').strip() for line in output.split('\n') if line]
-        return jsonify({"status": "success", "apps": sorted(apps)})
-    return jsonify({"status": "error", "message": "Could not list apps."})
+    data = request.get_json(silent=True) or {}
+    try:
+        offset = max(int(data.get('offset') or 0), 0)
+        limit = int(data['limit']) if data.get('limit') else None
+    except (TypeError, ValueError): return jsonify({"error": "Invalid offset or limit."}), 400
+    entry, error = package_catalog.get(device_id, refresh=bool(data.get('refresh')))
+    if not entry: return jsonify({"status": "error", "message": f"Could not list apps. {error}"})
+    matches = search_packages(entry, str(data.get('q') or ''), data.get('match', 'substring'), data.get('sort', 'name'))
+    page = matches[offset:offset + limit] if limit else matches[offset:]
+    return jsonify({
+        "status": "success", "apps": [package["package"] for package in page], "packages": page,
+        "total": len(matches), "offset": offset, "limit": limit, "catalog_built": entry["built"],
+    })
 
 @app.route('/uninstall_app', methods=['POST'])
 def uninstall_app():
@@ -368,6 +2976,8 @@ def uninstall_app():
     package_name = request.json.get('package_name')
     if not package_name: return jsonify({"status": "error", "message": "No package name provided."}), 400
     success, output = run_command(["adb", "-s", device_id, "uninstall", package_name])
+    forget_installed_apks(device_id, package_name)
+    package_catalog.invalidate(device_id)
     if success and "Success" in output:
         return jsonify({"status": "success", "message": f"Successfully uninstalled {package_name}."})
     return jsonify({"status": "error", "message": f"Failed to uninstall: {output}"})
@@ -381,15 +2991,90 @@ def pull_file():
     if not phone_path: return jsonify({"error": "No file path provided."}), 400
     filename = os.path.basename(phone_path)
     pc_path = os.path.join(app.config['PULLED_FILES_FOLDER'], secure_filename(filename))
-    success, output = run_command(["adb", "-s", device_id, "pull", phone_path, pc_path], timeout=120)
-    if success: return jsonify({"status": "success", "message": f"Pulled {filename}."})
+    # -a keeps the device mtime, which is how /files/download recognizes the local copy later.
+    success, output = run_command(["adb", "-s", device_id, "pull", "-a", phone_path, pc_path], timeout=120)
+    if success: return jsonify({"status": "success", "message": f"Pulled {filename}.", "url": local_file_url(secure_filename(filename))})
     return jsonify({"status": "error", "message": f"Failed to pull file: {output}"})
 
+@app.route('/files/list', methods=['POST'])
+def list_files():
+    if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    device_id = get_connected_device()
+    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
+    data = request.get_json(silent=True) or {}
+    path = device_path(data.get('path') or '/sdcard')
+    if not path: return jsonify({"error": "Give an absolute path."}), 400
+    entries, error = file_listings.get(device_id, path, refresh=bool(data.get('refresh')))
+    if entries is None: return jsonify({"status": "error", "message": error}), 404
+    # Files come with a signed /files/download link (the cached entries themselves are shared, so they are copied).
+    entries = [{**entry, "url": file_download_url(device_id, posixpath.join(path, entry["name"]))} if entry["type"] == 'file' else entry for entry in entries]
+    return jsonify({"status": "success", "path": path, "parent": posixpath.dirname(path) if path != '/' else None, "entries": entries})
+
+@app.route('/files/download', methods=['GET'])
+def download_file():
+    # ?path=/sdcard/...&serial=...&token=... as listed by /files/list (&download=1 for an attachment); honours Range and If-Range.
+    path = device_path(request.args.get('path'))
+    if not path: return jsonify({"error": "Give an absolute file path."}), 400
+    if not has_media_token(request, path, request.args.get('serial', '')): return jsonify({"error": "Unauthorized"}), 401
+    device_id = get_connected_device()
+    if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
+    entry, error = file_listings.stat(device_id, path)
+    if not entry: return jsonify({"status": "error", "message": error}), 404
+    if entry["type"] != 'file': return jsonify({"status": "error", "message": f"{path} is not a regular file."}), 400
+    size, name, attachment = entry["size"], entry["name"], bool(request.args.get('download'))
+    local_path = os.path.join(app.config['PULLED_FILES_FOLDER'], secure_filename(name))
+    if os.path.isfile(local_path) and os.path.getsize(local_path) == size and int(os.path.getmtime(local_path)) == entry["mtime"]:
+        return send_file(os.path.abspath(local_path), conditional=True, as_attachment=attachment, download_name=name)
+    etag = f"{size:x}-{entry['mtime'] or 0:x}"
+    ranges = request.range
+    if ranges and request.headers.get('If-Range') and request.if_range.etag != etag: ranges = None
+    span = ranges.range_for_length(size) if ranges else None
+    if ranges and not span and len(ranges.ranges) == 1:
+        return Response(status=416, headers={"Content-Range": f"bytes */{size}", "Accept-Ranges": "bytes"})
+    start, stop = span or (0, size)
+    command = f"dd if={shlex.quote(path)} bs=65536 iflag=skip_bytes,count_bytes skip={start} count={stop - start} 2>/dev/null" if span else f"cat {shlex.quote(path)}"
+    try: source = ExecSource(device_id, command, FILE_STREAM_TIMEOUT, watchdog=False)
+    except (OSError, AdbServerError) as e: return jsonify({"status": "error", "message": f"Download failed: {e}"}), 500
+    headers = {
+        "Accept-Ranges": "bytes", "Content-Length": str(stop - start), "ETag": f'"{etag}"',
+        "Content-Disposition": content_disposition(name, attachment),
+    }
+    if entry["mtime"]: headers["Last-Modified"] = http_date(entry["mtime"])
+    if span: headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    response = Response(source.chunks(), status=206 if span else 200, mimetype=mimetype, headers=headers)
+    response.call_on_close(source.close) # also when the client goes away before the first chunk
+    return response
+
+@app.route('/files/local/<path:name>', methods=['GET'])
+def local_file(name):
+    # Files in pulled_files/ go out through send_file (wsgi.file_wrapper/sendfile where the server supports it).
+    if not has_media_token(request, name): return jsonify({"error": "Unauthorized"}), 401
+    return send_from_directory(os.path.abspath(app.config['PULLED_FILES_FOLDER']), name, conditional=True, as_attachment=bool(request.args.get('download')))
+
+def push_file_job(job, device_id, pc_path, phone_path, filename):
+    try:
+        progress = device_progress(device_id, phone_path, os.path.getsize(pc_path))
+        success, output = job.run(["adb", "-s", device_id, "push", pc_path, phone_path], timeout=120, progress=progress)
+    finally:
+        os.remove(pc_path)
+    file_listings.invalidate(device_id, posixpath.dirname(phone_path))
+    if success: return True, f"Pushed {filename}."
+    return False, f"Failed to push file: {output}"
+
 @app.route('/push_file', methods=['POST'])
 def push_file():
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
     device_id = get_connected_device()
     if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
+    if STREAMING_UPLOADS and StreamedUpload.supported(request):
+        upload = StreamedUpload(request)
+        if not upload.filename: return jsonify({"error": "No selected file"}), 400
+        filename = secure_filename(upload.filename)
+        phone_path = f"/sdcard/Download/{filename}"
+        total_size = int(request.headers.get('X-Upload-Size') or 0) or None
+        job = jobs.run_inline('push_file', device_id, f"Push {filename}", streamed_push_job, device_id, upload, phone_path, filename, total_size)
+        return job_finished(job)
     if 'file' not in request.files: return jsonify({"error": "No file part"}), 400
     file = request.files['file']
     if file.filename == '': return jsonify({"error": "No selected file"}), 400
@@ -397,25 +3082,63 @@ def push_file():
     pc_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     file.save(pc_path)
     phone_path = f"/sdcard/Download/{filename}"
-    success, output = run_command(["adb", "-s", device_id, "push", pc_path, phone_path], timeout=120)
-    if success: return jsonify({"status": "success", "message": f"Pushed {filename}."})
-    return jsonify({"status": "error", "message": f"Failed to push file: {output}"}), 500
+    job = jobs.submit('push_file', device_id, f"Push {filename}", push_file_job, device_id, pc_path, phone_path, filename)
+    return job_started(job, f"Pushing {filename}...")
+
+def install_apk_job(job, device_id, pc_path, filename, force=False):
+    try:
+        digest, size = hashlib.sha256(), os.path.getsize(pc_path)
+        with open(pc_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''): digest.update(chunk)
+        if not force and apk_already_installed(device_id, digest.hexdigest()):
+            job.result = {"sha256": digest.hexdigest(), "bytes": size, "skipped": True}
+            return True, "This APK is already installed on the device. Skipped."
+        success, output = job.run(["adb", "-s", device_id, "install", "-r", pc_path], timeout=120)
+    finally: os.remove(pc_path)
+    package_catalog.invalidate(device_id)
+    if success and ("Success" in output or "success" in output.lower()):
+        remember_installed_apk(device_id, digest.hexdigest(), size)
+        return True, f"Successfully installed {filename}."
+    return False, f"Failed to install APK: {output}"
+
+def install_apk_fan_out(targets, force):
+    serials, results = targets
+    size = request.headers.get('X-Upload-Size', '')
+    if not (StreamedUpload.supported(request) and size.isdigit()):
+        return jsonify({"error": "Multi-device installs need a multipart upload with X-Upload-Size."}), 400
+    if not serials: return fan_out_response(results)
+    upload = StreamedUpload(request)
+    if not upload.filename: return jsonify({"error": "No selected file"}), 400
+    filename = secure_filename(upload.filename)
+    job = jobs.run_inline('install_apk', ','.join(serials), f"Install {filename} on {len(serials)} devices", fanout_install_job, serials, upload, int(size), filename, results, force)
+    if job.result: return fan_out_response(job.result["results"], job_id=job.id)
+    return jsonify({"status": "error", "job_id": job.id, "message": job.message}), 500
 
 @app.route('/install_apk', methods=['POST'])
 def install_apk():
     if not is_authorized(request): return jsonify({"error": "Unauthorized"}), 401
+    # An APK the panel already installed is recognised by the hash of the upload and not installed again.
+    force = bool(request.headers.get('X-Force-Install'))
+    targets = requested_targets()
+    if targets is not None: return install_apk_fan_out(targets, force)
     device_id = get_connected_device()
     if not device_id: return jsonify({"status": "error", "message": "No device connected."}), 400
+    size = request.headers.get('X-Upload-Size', '')
+    # pm needs the exact APK size up front; without it fall back to staging the upload.
+    if STREAMING_UPLOADS and StreamedUpload.supported(request) and size.isdigit():
+        upload = StreamedUpload(request)
+        if not upload.filename: return jsonify({"error": "No selected file"}), 400
+        filename = secure_filename(upload.filename)
+        job = jobs.run_inline('install_apk', device_id, f"Install {filename}", streamed_install_job, device_id, upload, int(size), filename, force)
+        return job_finished(job)
     if 'file' not in request.files: return jsonify({"error": "No file part"}), 400
     file = request.files['file']
     if file.filename == '': return jsonify({"error": "No selected file"}), 400
     filename = secure_filename(file.filename)
     pc_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     file.save(pc_path)
-    success, output = run_command(["adb", "-s", device_id, "install", "-r", pc_path], timeout=120)
-    if success and ("Success" in output or "success" in output.lower()):
-        return jsonify({"status": "success", "message": f"Successfully installed {filename}."})
-    return jsonify({"status": "error", "message": f"Failed to install APK: {output}"}), 500
+    job = jobs.submit('install_apk', device_id, f"Install {filename}", install_apk_job, device_id, pc_path, filename, force)
+    return job_started(job, f"Installing {filename}...")
 
 if __name__ == '__main__':
     if API_SECRET_KEY == "pogiako" or API_SECRET_KEY == "YourSuperSecretKey123!@#":
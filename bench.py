@@ -0,0 +1,805 @@
+"""Latency/throughput benchmark for every route in app.py, no phone required.
+
+A fake adb stands in for the device: a local adb-server look-alike (smart-socket protocol, shell v2
+and exec: services) plus `adb`/`scrcpy` stubs put first on PATH. Both answer from the same canned
+device model and sleep --latency seconds per adb command. Routes are driven through Flask's test
+client, or under concurrent HTTP load with --mode http, and the report lists p50/p95/p99 latency,
+requests per second, subprocess spawns and adb-server connections per request.
+
+    python bench.py                                   # test client, both transports
+    python bench.py --transport cli --latency 0.02 --routes get_device_info,list_apps
+    python bench.py --mode http --concurrency 8 --requests 200
+    python bench.py --output before.json ... ; python bench.py --compare before.json
+
+The CLI stubs are POSIX shell scripts, so on Windows use --transport server. Results go to
+bench_results.json (see --output); --compare exits with status 1 when a route's p50 or p95 got
+slower than --threshold percent.
+"""
+import argparse
+import hashlib
+import importlib.util
+import io
+import json
+import math
+import os
+import platform
+import posixpath
+import re
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+BENCH_PATH = os.path.abspath(__file__)
+REPO_ROOT = os.path.dirname(BENCH_PATH)
+DEFAULT_OUTPUT = 'bench_results.json'
+
+# --- Fake Device ---
+# Everything both fakes know about the phone. Shell scripts are split on top-level ';' and each
+# command is answered from CANNED_COMMANDS, so the batched scripts app.py sends work unchanged.
+DEVICES = {'BENCH001': 'device', '10.0.0.2:5555': 'device', 'BENCH003': 'unauthorized'}
+PHOTOS = {f"IMG_{i:04d}.jpg": (48 * 1024 + i, 1700000000 + i) for i in range(1, 9)}
+PACKAGES = [(f"com.bench.app{i:03d}", i, 10100 + i) for i in range(1, 121)]
+FILES = {
+    '/sdcard/Movies/clip.mp4': (8 * 1024 * 1024, 1700000100), '/sdcard/Download/report.pdf': (120 * 1024, 1700000200),
+    '/sdcard/Download/notes.txt': (2048, 1700000300), **{f"/sdcard/DCIM/Camera/{name}": entry for name, entry in PHOTOS.items()},
+}
+
+def tiny_png(width=64, height=128):
+    def chunk(kind, data): return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + bytes((x + y) % 256 for x in range(width * 3)) for y in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+def state_path(path):
+    # Files "written" to the fake phone live in a state dir shared by the server and the CLI stub.
+    return os.path.join(os.environ['NEXUS_BENCH_STATE'], hashlib.sha1(path.strip("'").encode()).hexdigest())
+
+def device_write(match, stdin):
+    with open(state_path(match.group(1)), 'w') as f: f.write(str(len(stdin)))
+    return ''
+
+def device_stat(match, stdin):
+    try:
+        with open(state_path(match.group(1))) as f: return f.read()
+    except OSError: return f"stat: '{match.group(1)}': No such file or directory", 1
+
+def pm_install(match, stdin):
+    if len(stdin) != int(match.group(1)): return f"Error: expected {match.group(1)} bytes, got {len(stdin)}", 1
+    return "Success"
+
+def cpu_line(match, stdin):
+    ticks = int(time.monotonic() * 100)
+    return f"cpu  {ticks // 3} 0 {ticks // 7} {ticks} 12 0 3 0 0 0"
+
+def photo_listing(match, stdin):
+    root = match.group(1).strip("'")
+    return '\n'.join(f"{size} {mtime} {root}{name}" for name, (size, mtime) in PHOTOS.items())
+
+def md5_listing(match, stdin):
+    return '\n'.join(f"{hashlib.md5(path.encode()).hexdigest()}  {path.strip(chr(39))}" for path in match.group(1).split())
+
+def file_bytes(path, start=0, length=None):
+    # Deterministic content, so range reads can be checked against full ones.
+    size = FILES[path][0]
+    stop = size if length is None else min(start + length, size)
+    pattern = hashlib.sha256(path.encode()).digest() * 64
+    offset = start % len(pattern)
+    return (pattern * ((offset + stop - start) // len(pattern) + 1))[offset:offset + stop - start]
+
+def stat_line(path, name):
+    if path in FILES: return f"regular file|{FILES[path][0]}|{FILES[path][1]}|660|{name}"
+    if any(known.startswith(path.rstrip('/') + '/') for known in FILES): return f"directory|3452|1700000000|771|{name}"
+    return None
+
+def list_directory(match, stdin):
+    root = match.group(1).strip("'").rstrip('/')
+    names = sorted({known[len(root) + 1:].split('/')[0] for known in FILES if known.startswith(root + '/')})
+    if not names and stat_line(root, root) is None: return f"/system/bin/sh: cd: {root}: No such file or directory", 1
+    return '\n'.join(stat_line(f"{root}/{name}", name) for name in names)
+
+def stat_file(match, stdin):
+    path = match.group(1).strip("'")
+    return stat_line(path, path) or (f"stat: '{path}': No such file or directory", 1)
+
+def read_file(match, stdin):
+    path = match.group(1).strip("'")
+    if path not in FILES: return f"cat: {path}: No such file or directory", 1
+    return file_bytes(path)
+
+def read_range(match, stdin):
+    path = match.group(1).strip("'")
+    if path not in FILES: return f"dd: {path}: No such file or directory", 1
+    return file_bytes(path, int(match.group(2)), int(match.group(3)))
+
+BACKUP_HEADER = b'ANDROID BACKUP\n5\n1\nnone\n'
+_backup_archive = None
+
+def backup_archive(match=None, stdin=b''):
+    # A compressed .ab of app data, half incompressible, built once; every backup sends the same one.
+    global _backup_archive
+    if _backup_archive is None:
+        data = b''.join(
+            hashlib.shake_128(b'%d' % block).digest(2048) if block % 2 else f"apps/com.bench.app{block:03d}/sp/prefs.xml {block}\n".encode() * 64
+            for block in range(4096)
+        )
+        _backup_archive = BACKUP_HEADER + zlib.compress(data, 1)
+    return _backup_archive
+
+def bu_restore(match, stdin):
+    if not stdin.startswith(BACKUP_HEADER): return "bu: not an Android backup", 1
+    try: zlib.decompress(stdin[len(BACKUP_HEADER):])
+    except zlib.error as e: return f"bu: corrupt backup: {e}", 1
+    return ''
+
+BATTERY = "Current Battery Service state:\n  AC powered: false\n  USB powered: true\n  status: 2\n  level: 87\n  temperature: 312"
+MEMINFO = "MemTotal:        7812340 kB\nMemFree:          512340 kB\nMemAvailable:    3012340 kB\nCached:          2012340 kB"
+PS_TABLE = "USER PID PPID VSZ RSS WCHAN ADDR S NAME\n" + '\n'.join(
+    f"u0_a{i} {1000 + i} 1 1234567 {20000 + i * 10} 0 0 S {name}" for i, (name, _, _) in enumerate(PACKAGES[:40])
+)
+PS_RSS = "RSS NAME\n" + '\n'.join(f"{20000 + i * 10} {name}" for i, (name, _, _) in enumerate(PACKAGES[:40]))
+NETSTAT = "Proto Recv-Q Send-Q Local Address Foreign Address State PID/Program name\n" + '\n'.join(
+    f"tcp 0 0 10.0.0.2:{40000 + i} 142.250.0.{i}:443 ESTABLISHED {1000 + i}/{name}" for i, (name, _, _) in enumerate(PACKAGES[:12])
+)
+PACKAGE_LIST = '\n'.join(f"package:/data/app/~~x/{name}-1/base.apk={name} versionCode:{code} uid:{uid}" for name, code, uid in PACKAGES)
+PACKAGE_DETAILS = '\n'.join(
+    f"  Package [{name}] (1a2b):\n    versionName=1.{code}\n    firstInstallTime=2024-01-01 10:00:00\n    lastUpdateTime=2024-06-01 10:00:{code % 60:02d}"
+    for name, code, _ in PACKAGES
+)
+PACKAGE_SIZES = '\n'.join(f"{1024 * 1024 + code} /data/app/~~x/{name}-1/base.apk" for name, code, _ in PACKAGES)
+
+# Whole scripts that only make sense together (the file browser's `cd || exit; stat ...; true`).
+CANNED_SCRIPTS = [
+    (r"cd (\S+) \|\| exit 1; stat -L -c .* 2>/dev/null; true", list_directory),
+]
+CANNED_SCRIPTS = [(re.compile(pattern + '$'), answer) for pattern, answer in CANNED_SCRIPTS]
+
+CANNED_COMMANDS = [
+    (r"echo '(.*)'", lambda match, stdin: match.group(1)),
+    (r"stat -L -c \S+ -- (\S+)", stat_file),
+    (r"dd if=(\S+) bs=\d+ iflag=skip_bytes,count_bytes skip=(\d+) count=(\d+) 2>/dev/null", read_range),
+    (r"getprop ro\.product\.model", "Pixel 7"),
+    (r"getprop ro\.build\.version\.release", "14"),
+    (r"getprop ro\.serialno", "BENCH001"),
+    (r"grep -m 1 '\^Hardware' /proc/cpuinfo", "Hardware\t: Tensor G2"),
+    (r"grep -m 1 '\^MemTotal' /proc/meminfo", "MemTotal:        7812340 kB"),
+    (r"grep -E .* /proc/meminfo", MEMINFO),
+    (r"dumpsys battery", BATTERY),
+    (r"head -n 1 /proc/stat", cpu_line),
+    (r"ps -A -o RSS,NAME", PS_RSS),
+    (r"ps -A", PS_TABLE),
+    (r"netstat -tnp", NETSTAT),
+    (r"settings get secure install_non_market_apps", "0"),
+    (r"settings get global adb_enabled", "1"),
+    (r"settings put .*|input keyevent \d+|am (start|force-stop) .*|svc wifi toggle|pm trim-caches .*", ""),
+    # The catalog lists packages once into $packages and derives sizes and the md5 from it.
+    (r"packages=\$\(pm list packages -3 -f -U --show-versioncode\)", ""),
+    (r'echo "\$packages"', PACKAGE_LIST),
+    (r'echo "\$packages" \| md5sum', hashlib.md5(PACKAGE_LIST.encode() + b'\n').hexdigest() + "  -"),
+    (r'echo "\$packages" \| sed .*', PACKAGE_SIZES),
+    (r"dumpsys package packages \| .*", PACKAGE_DETAILS),
+    (r"pm install -r -S (\d+)", pm_install),
+    (r"find (\S+) -type f -exec stat .*", photo_listing),
+    (r"md5sum (.+)", md5_listing),
+    (r"cat > (\S+)", device_write),
+    (r"cat (\S+)", read_file),
+    (r"stat -c %s (\S+)", device_stat),
+    (r"rm -f .*", ""),
+    (r"screencap -p", tiny_png()),
+    (r"bu backup -all", backup_archive),
+    (r"bu restore", bu_restore),
+    (r"ls( .*)?", "Alarms\nDCIM\nDownload\nMovies\nMusic\nPictures"),
+    (r"uptime", " 10:00:00 up 3 days,  2:11,  0 users,  load average: 1.02, 0.88, 0.71"),
+]
+CANNED_COMMANDS = [(re.compile(pattern + '$'), answer) for pattern, answer in CANNED_COMMANDS]
+
+def split_script(script):
+    commands, current, quote = [], [], None
+    for char in script:
+        if quote:
+            if char == quote: quote = None
+        elif char in "'\"": quote = char
+        elif char in ';\n':
+            commands.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+    commands.append(''.join(current))
+    return [command.strip() for command in commands if command.strip()]
+
+def run_script(script, stdin=b''):
+    # Returns (stdout bytes, exit code) for a whole shell script.
+    output, code = [], 0
+    for pattern, answer in CANNED_SCRIPTS:
+        match = pattern.match(script.strip())
+        if match: return run_script_answer(answer(match, stdin))
+    for command in split_script(script):
+        for pattern, answer in CANNED_COMMANDS:
+            match = pattern.match(command)
+            if not match: continue
+            result = answer(match, stdin) if callable(answer) else answer
+            result, code = result if isinstance(result, tuple) else (result, 0)
+            break
+        else:
+            result, code = f"/system/bin/sh: {command.split()[0]}: inaccessible or not found", 127
+        result, code = run_script_answer((result, code))
+        output.append(result)
+    return b''.join(output), code
+
+def run_script_answer(result):
+    result, code = result if isinstance(result, tuple) else (result, 0)
+    if isinstance(result, str): result = (result + '\n' if result else '').encode()
+    return result, code
+
+# --- Fake ADB Server ---
+class FakeAdbServer:
+    def __init__(self, latency):
+        self.latency = latency
+        self._listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, name='fake-adb-server', daemon=True).start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self._listener.accept()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _recv_exact(conn, size):
+        data = b''
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk: raise ConnectionError()
+            data += chunk
+        return data
+
+    @staticmethod
+    def _fail(conn, message):
+        message = message.encode()
+        conn.sendall(b'FAIL' + b'%04x' % len(message) + message)
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                while True:
+                    service = self._recv_exact(conn, int(self._recv_exact(conn, 4), 16)).decode()
+                    if not self._handle(conn, service): return
+            except (ConnectionError, OSError):
+                pass
+
+    def _handle(self, conn, service):
+        # Returns True when the connection carries on with another request (after host:transport).
+        if service == 'host:devices':
+            payload = ''.join(f"{serial}\t{state}\n" for serial, state in DEVICES.items()).encode()
+            conn.sendall(b'OKAY' + b'%04x' % len(payload) + payload)
+        elif service.startswith('host:track-devices'):
+            payload = ''.join(
+                f"{serial:<22}{state} product:panther model:Pixel_7 device:panther transport_id:{i}\n"
+                for i, (serial, state) in enumerate(DEVICES.items(), 1)
+            ).encode()
+            conn.sendall(b'OKAY' + b'%04x' % len(payload) + payload)
+            while conn.recv(1): pass # held open, like the real server, until the client goes away
+        elif service == 'host:features' or re.fullmatch(r'host-serial:.+:features', service):
+            serial = service[len('host-serial:'):-len(':features')] if service.startswith('host-serial:') else next(iter(DEVICES))
+            if serial not in DEVICES:
+                self._fail(conn, f"device '{serial}' not found")
+                return False
+            payload = b'shell_v2,cmd,stat_v2,ls_v2,fixed_push_mkdir,apex,abb,abb_exec'
+            conn.sendall(b'OKAY' + b'%04x' % len(payload) + payload)
+        elif service.startswith('host:transport'):
+            serial = service.split(':', 2)[2] if service.startswith('host:transport:') else next(iter(DEVICES))
+            if DEVICES.get(serial) != 'device':
+                self._fail(conn, f"device '{serial}' not found" if serial not in DEVICES else f"device unauthorized")
+                return False
+            conn.sendall(b'OKAY')
+            return True
+        elif service.startswith('shell,v2,raw:'):
+            time.sleep(self.latency)
+            conn.sendall(b'OKAY')
+            output, code = run_script(service.split(':', 1)[1])
+            conn.sendall(struct.pack('<BI', 1, len(output)) + output + struct.pack('<BI', 3, 1) + bytes([code & 0xff]))
+        elif service.startswith('exec:'):
+            time.sleep(self.latency)
+            conn.sendall(b'OKAY')
+            command = service[len('exec:'):]
+            stdin = b''
+            if re.match(r'(cat >|pm install|bu restore)', command):
+                stdin = b''.join(iter(lambda: conn.recv(65536), b''))
+            conn.sendall(run_script(command, stdin)[0])
+        else:
+            self._fail(conn, f"unknown service: {service}")
+        return False
+
+# --- Fake CLI ---
+# Invoked as `python bench.py --fake-adb ...` by the adb stub on PATH.
+def fake_adb_cli(args):
+    time.sleep(float(os.environ.get('NEXUS_BENCH_LATENCY', 0)))
+    serial = None
+    if args[:1] == ['-s']: serial, args = args[1], args[2:]
+    command, rest = (args[0], args[1:]) if args else ('', [])
+    out = sys.stdout.buffer
+    if command == 'devices':
+        out.write(b'List of devices attached\n')
+        for serial, state in DEVICES.items():
+            out.write((f"{serial:<22}{state} product:panther model:Pixel_7 device:panther\n" if rest == ['-l'] else f"{serial}\t{state}\n").encode())
+        return 0
+    if command in ('connect', 'disconnect'):
+        out.write(f"{'connected to' if command == 'connect' else 'disconnected'} {rest[0]}\n".encode())
+        return 0
+    if DEVICES.get(serial) != 'device':
+        sys.stderr.write(f"adb: device '{serial}' not found\n")
+        return 1
+    if command in ('shell', 'exec-out', 'exec-in'):
+        stdin = sys.stdin.buffer.read() if command == 'exec-in' else b''
+        output, code = run_script(' '.join(rest), stdin)
+        out.write(output)
+        return code
+    if command == 'pull':
+        preserve = rest[:1] == ['-a']
+        source, destination = rest[-2:]
+        if source.rstrip('/').endswith('Camera'):
+            folder = os.path.join(destination, 'Camera')
+            os.makedirs(folder, exist_ok=True)
+            for name, (size, _) in PHOTOS.items():
+                with open(os.path.join(folder, name), 'wb') as f: f.write(b'\0' * size)
+        else:
+            size, mtime = FILES.get(source, (64 * 1024, None))
+            with open(destination, 'wb') as f: f.write(file_bytes(source) if source in FILES else b'\0' * size)
+            if preserve and mtime: os.utime(destination, (mtime, mtime))
+        if sys.stdout.isatty(): out.write(b"[100%] " + source.encode() + b"\n")
+        out.write(f"{source}: 1 file pulled, 0 skipped.\n".encode())
+        return 0
+    if command == 'push':
+        # Like real adb, "[ 42%]" lines only go to a terminal.
+        if sys.stdout.isatty():
+            for percent in (25, 50, 75, 100): out.write(f"[{percent:3d}%] {rest[-1]}\r".encode())
+        size = os.path.getsize(rest[-2])
+        with open(state_path(rest[-1]), 'w') as f: f.write(str(size))
+        out.write(f"{rest[-2]}: 1 file pushed, 0 skipped. ({size} bytes in 0.001s)\n".encode())
+        return 0
+    if command in ('install', 'uninstall'):
+        out.write(b"Performing Streamed Install\nSuccess\n" if command == 'install' else b"Success\n")
+        return 0
+    if command == 'backup':
+        with open(rest[rest.index('-f') + 1], 'wb') as f: f.write(b'ANDROID BACKUP\n5\n1\nnone\n' + b'\0' * 4096)
+        return 0
+    sys.stderr.write(f"adb: unknown command {command}\n")
+    return 1
+
+def fake_scrcpy_cli(args):
+    # Mirrors until terminated, like the real thing.
+    if '--record' in args: open(args[args.index('--record') + 1], 'wb').close()
+    try: time.sleep(3600)
+    except KeyboardInterrupt: pass
+    return 0
+
+def install_stubs(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, flag in (('adb', '--fake-adb'), ('scrcpy', '--fake-scrcpy')):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f: f.write(f'#!/bin/sh\nexec "{sys.executable}" "{BENCH_PATH}" {flag} "$@"\n')
+        os.chmod(path, 0o755)
+
+# --- Instrumentation ---
+class Counters:
+    # Subprocess spawns and adb-server connections, counted process-wide.
+    def __init__(self):
+        self.spawns = 0
+        self.adb_connections = 0
+        self._lock = threading.Lock()
+
+    def install(self, app_module):
+        counters = self
+        popen_init = subprocess.Popen.__init__
+        connect = app_module.AdbServerClient._connect
+
+        def counting_popen_init(popen, *args, **kwargs):
+            with counters._lock: counters.spawns += 1
+            popen_init(popen, *args, **kwargs)
+
+        def counting_connect(client, *args, **kwargs):
+            with counters._lock: counters.adb_connections += 1
+            return connect(client, *args, **kwargs)
+
+        subprocess.Popen.__init__ = counting_popen_init
+        app_module.AdbServerClient._connect = counting_connect
+
+    def snapshot(self):
+        return self.spawns, self.adb_connections
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(q * len(ordered)) - 1, 0)] if ordered else None
+
+# --- Scenarios ---
+class Scenario:
+    def __init__(self, name, path, body=None, method='POST', upload=None, setup=None, teardown=None,
+                 waits_for_jobs=False, exclusive=False, expect=(200,), headers=None):
+        self.name = name
+        self.path = path
+        self.body = body
+        self.method = method
+        self.upload = upload # (field filename, size, extra headers)
+        self.setup = setup # setup(bench) -> path parameters, run before every request, untimed
+        self.teardown = teardown # teardown(bench), run after each request, untimed
+        self.waits_for_jobs = waits_for_jobs # spawns of the background job count towards the request
+        self.exclusive = exclusive # never run concurrently with itself
+        self.expect = expect
+        self.headers = headers or {}
+
+    def build(self, bench, params):
+        headers = {"X-Api-Key": bench.app.API_SECRET_KEY, "X-Device-Serial": 'BENCH001', **self.headers}
+        path = self.path.format(**params)
+        if self.upload:
+            from werkzeug.datastructures import FileStorage
+            from werkzeug.test import encode_multipart
+            filename, size, extra = self.upload
+            boundary, body = encode_multipart({"file": FileStorage(bench.upload_file(size), filename)})
+            headers.update({"Content-Type": f"multipart/form-data; boundary={boundary}", "X-Upload-Size": str(size), **extra})
+            return self.method, path, headers, body
+        if self.body is None: return self.method, path, headers, None
+        headers["Content-Type"] = "application/json"
+        return self.method, path, headers, json.dumps(self.body).encode()
+
+def started_job(path, body=None):
+    def setup(bench):
+        response = bench.call('POST', path, body or {})
+        bench.drain_jobs()
+        return {"job_id": response.get('job_id', 'missing')}
+    return setup
+
+def waiting_job(bench):
+    # Still running when the request arrives, so cancelling it takes the real path.
+    job = bench.app.jobs.submit('bench', 'BENCH001', "Waits to be cancelled", lambda job: job.sleep(60))
+    return {"job_id": job.id}
+
+def finished_stream(bench):
+    client = bench.app.app.test_client()
+    response = client.post('/execute_shell/stream', json={"command": "ls /sdcard"}, headers=bench.headers())
+    session = re.search(r'"id": "(\w+)"', response.get_data(as_text=True))
+    return {"stream_id": session.group(1) if session else 'missing'}
+
+def saved_screenshot(bench):
+    response = bench.app.app.test_client().post('/screenshot', json={"save": True}, headers=bench.headers())
+    return {"name": response.headers.get('X-Screenshot-File', 'missing')}
+
+def pulled_file(bench):
+    response = bench.call('POST', '/pull_file', {"path": "/sdcard/Download/report.pdf"})
+    return {"name": "report.pdf", "query": response.get('url', '?').split('?', 1)[1]}
+
+def listed_file(path, pull=False):
+    # The signed /files/download link the file browser gets from /files/list.
+    directory, name = posixpath.split(path)
+    def setup(bench):
+        if pull: bench.call('POST', '/pull_file', {"path": path})
+        listing = bench.call('POST', '/files/list', {"path": directory})
+        url = next((entry["url"] for entry in listing.get('entries', ()) if entry["name"] == name), '?')
+        return {"query": url.split('?', 1)[1]}
+    return setup
+
+def stored_backup(bench):
+    response = bench.call('POST', '/backup_device', {})
+    bench.drain_jobs()
+    job = bench.app.jobs.get(response.get('job_id', ''))
+    backup_id = ((job.result or {}).get('id') if job else None) or 'missing'
+    url = next((backup["url"] for backup in bench.call('POST', '/backups').get('backups', ()) if backup["id"] == backup_id), '?')
+    return {"backup_id": backup_id, "query": url.split('?', 1)[1]}
+
+def sampled_telemetry(bench):
+    bench.app.telemetry_sampler.sample('BENCH001')
+    return {}
+
+def stop_mirror(bench):
+    bench.call('POST', '/stop_mirror', {})
+    deadline = time.monotonic() + 10
+    while bench.app.mirror_sessions.usage()['used'] and time.monotonic() < deadline: time.sleep(0.005)
+
+def running_session(bench):
+    session = bench.call('POST', '/start_mirror', {"preset": "low"}).get('session') or {}
+    return {"session_id": session.get('id', 'missing')}
+
+def drain_jobs(bench):
+    bench.drain_jobs()
+
+def stop_telemetry(bench):
+    bench.app.telemetry_sampler.stop()
+
+def scenarios(scan_port):
+    scan = {"network": "127.0.0.1/32", "ports": [scan_port], "vendor": False}
+    return [
+        Scenario('index', '/', method='GET'),
+        Scenario('devices', '/devices', {}),
+        Scenario('get_device_info', '/get_device_info', {}),
+        Scenario('get_device_info_refresh', '/get_device_info', {"refresh": True}),
+        Scenario('security_audit', '/security_audit', {}),
+        Scenario('clear_caches', '/clear_caches', {}),
+        Scenario('metrics', '/metrics', method='GET'),
+        Scenario('metrics_slow', '/metrics/slow', {}),
+        Scenario('get_device_info_profiled', '/get_device_info', {}, headers={"X-Profile": "1"}),
+        Scenario('get_connections', '/get_connections', {}),
+        Scenario('process_list', '/process_manager', {"action": "list"}),
+        Scenario('process_kill', '/process_manager', {"action": "kill", "package_name": "com.bench.app001"}),
+        Scenario('execute_shell', '/execute_shell', {"command": "ls /sdcard"}),
+        Scenario('execute_shell_fanout', '/execute_shell', {"command": "ls /sdcard", "targets": "all"}),
+        Scenario('execute_shell_stream', '/execute_shell/stream', {"command": "ls /sdcard"}),
+        Scenario('shell_streams', '/shell_streams', {}),
+        Scenario('shell_stream_events', '/shell_streams/{stream_id}/events', method='GET', setup=finished_stream),
+        Scenario('shell_stream_cancel', '/shell_streams/{stream_id}/cancel', {}, setup=finished_stream),
+        Scenario('device_action', '/device_action', {"action": "volume_up"}),
+        Scenario('device_action_fanout', '/device_action', {"action": "volume_up", "targets": "all"}),
+        Scenario('device_action_screenshot', '/device_action', {"action": "screenshot"}),
+        Scenario('screenshot', '/screenshot', {}),
+        Scenario('screenshot_burst', '/screenshot_burst', {"fps": 10, "count": 3}, waits_for_jobs=True, expect=(202,)),
+        Scenario('screenshots', '/screenshots', {}),
+        # Thumbnails need Pillow; without it the route can only answer 404, so it is left uncovered.
+        *([Scenario('screenshot_thumbnail', '/screenshots/{name}/thumbnail', method='GET', setup=saved_screenshot)] if importlib.util.find_spec('PIL') else []),
+        Scenario('list_apps', '/list_apps', {}),
+        Scenario('list_apps_refresh', '/list_apps', {"refresh": True}),
+        Scenario('list_apps_search', '/list_apps', {"q": "com.bench.app01", "match": "prefix", "limit": 20}),
+        Scenario('uninstall_app', '/uninstall_app', {"package_name": "com.bench.app001"}),
+        Scenario('pull_file', '/pull_file', {"path": "/sdcard/Download/report.pdf"}),
+        Scenario('files_list', '/files/list', {"path": "/sdcard/Download"}),
+        Scenario('files_list_refresh', '/files/list', {"path": "/sdcard/Download", "refresh": True}),
+        Scenario('files_download', '/files/download?{query}', method='GET', setup=listed_file('/sdcard/Movies/clip.mp4')),
+        Scenario('files_download_range', '/files/download?{query}', method='GET', setup=listed_file('/sdcard/Movies/clip.mp4'), headers={"Range": "bytes=4194304-4456447"}, expect=(206,)),
+        Scenario('files_download_pulled', '/files/download?{query}', method='GET', setup=listed_file('/sdcard/Download/report.pdf', pull=True)),
+        Scenario('files_local', '/files/local/{name}?{query}', method='GET', setup=pulled_file),
+        Scenario('push_file', '/push_file', upload=('bench.bin', 256 * 1024, {})),
+        Scenario('install_apk', '/install_apk', upload=('bench.apk', 1024 * 1024, {"X-Force-Install": "1"})),
+        Scenario('backup_device', '/backup_device', {}, waits_for_jobs=True, expect=(202,)),
+        Scenario('backup_device_ab', '/backup_device', {"format": "ab"}, waits_for_jobs=True, expect=(202,)),
+        Scenario('backups', '/backups', {}),
+        Scenario('backup_restore', '/backups/{backup_id}/restore', {}, setup=stored_backup, waits_for_jobs=True, expect=(202,)),
+        Scenario('backup_download', '/backups/{backup_id}/download?{query}', method='GET', setup=stored_backup),
+        Scenario('backup_delete', '/backups/{backup_id}/delete', {}, setup=stored_backup),
+        Scenario('download_photos_sync', '/download_photos', {}, waits_for_jobs=True, expect=(202,)),
+        Scenario('download_photos_full', '/download_photos', {"mode": "full"}, waits_for_jobs=True, expect=(202,)),
+        Scenario('jobs', '/jobs', {}),
+        Scenario('job', '/jobs/{job_id}', method='GET', setup=started_job('/backup_device')),
+        Scenario('job_cancel', '/jobs/{job_id}/cancel', {}, setup=waiting_job, teardown=drain_jobs, exclusive=True),
+        Scenario('telemetry_start', '/telemetry/start', {"interval": 3600}, teardown=stop_telemetry, exclusive=True),
+        Scenario('telemetry_stop', '/telemetry/stop', {}),
+        Scenario('telemetry', '/telemetry', {"window": 3600, "buckets": 60}, setup=sampled_telemetry),
+        Scenario('scan_network', '/scan_network', scan),
+        Scenario('scan_network_stream', '/scan_network/stream', scan),
+        Scenario('connect', '/connect', {"ip_port": "10.0.0.2:5555"}),
+        Scenario('launch_pc_client', '/launch_pc_client', {"ip": "10.0.0.2"}, expect=(200, 500)),
+        Scenario('start_mirror', '/start_mirror', {}, teardown=stop_mirror, exclusive=True),
+        Scenario('start_recording', '/start_recording', {}, teardown=stop_mirror, exclusive=True),
+        Scenario('stop_mirror', '/stop_mirror', {}),
+        Scenario('sessions', '/sessions', {}),
+        Scenario('session_stop', '/sessions/{session_id}/stop', {}, setup=running_session, teardown=stop_mirror, exclusive=True),
+    ]
+
+# --- Runner ---
+class Bench:
+    def __init__(self, app_module, counters, workdir):
+        self.app = app_module
+        self.counters = counters
+        self.workdir = workdir
+        self._uploads = {}
+
+    def headers(self):
+        return {"X-Api-Key": self.app.API_SECRET_KEY, "X-Device-Serial": 'BENCH001'}
+
+    def call(self, method, path, body=None):
+        response = self.app.app.test_client().open(path, method=method, json=body, headers=self.headers())
+        return response.get_json(silent=True) or {}
+
+    def upload_file(self, size):
+        if size not in self._uploads: self._uploads[size] = os.urandom(size)
+        return io.BytesIO(self._uploads[size])
+
+    def drain_jobs(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(job['status'] in ('queued', 'running') for job in self.app.jobs.list()):
+            time.sleep(0.005)
+
+    def run_client(self, scenario, requests, warmup):
+        client = self.app.app.test_client()
+        latencies, statuses, spawns, connections = [], {}, 0, 0
+        for i in range(warmup + requests):
+            params = scenario.setup(self) if scenario.setup else {}
+            method, path, headers, body = scenario.build(self, params)
+            before = self.counters.snapshot()
+            started = time.perf_counter()
+            response = client.open(path, method=method, headers=headers, data=body)
+            response.get_data() # drains streamed responses
+            elapsed = time.perf_counter() - started
+            if scenario.waits_for_jobs: self.drain_jobs()
+            after = self.counters.snapshot()
+            if scenario.teardown: scenario.teardown(self)
+            if i < warmup: continue
+            latencies.append(elapsed)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            spawns += after[0] - before[0]
+            connections += after[1] - before[1]
+        return latencies, statuses, spawns, connections, sum(latencies)
+
+    def run_http(self, scenario, requests, warmup, concurrency, port):
+        import http.client
+        from concurrent.futures import ThreadPoolExecutor
+        # Every request gets its own setup, done before the clock and the spawn counters start. Exclusive
+        # scenarios (e.g. one mirror per device) set up right before each request instead, and what the
+        # setup cost is taken back out; that is exact because they run one at a time.
+        params = {} if scenario.exclusive else {i: scenario.setup(self) if scenario.setup else {} for i in range(warmup + requests)}
+        setup_cost = [0, 0, 0.0] # spawns, connections, seconds
+
+        def one(index):
+            if index not in params:
+                before, started = self.counters.snapshot(), time.perf_counter()
+                params[index] = scenario.setup(self) if scenario.setup else {}
+                after = self.counters.snapshot()
+                if index >= warmup:
+                    setup_cost[0] += after[0] - before[0]
+                    setup_cost[1] += after[1] - before[1]
+                    setup_cost[2] += time.perf_counter() - started
+            method, path, headers, body = scenario.build(self, params[index])
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+            try:
+                started = time.perf_counter()
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                return response.status, time.perf_counter() - started
+            finally:
+                conn.close()
+                if scenario.teardown and scenario.exclusive: scenario.teardown(self)
+
+        workers = 1 if scenario.exclusive else concurrency
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(one, range(warmup)))
+            self.drain_jobs()
+            before = self.counters.snapshot()
+            started = time.perf_counter()
+            results = list(pool.map(one, range(warmup, warmup + requests)))
+            wall = time.perf_counter() - started - setup_cost[2]
+        if scenario.waits_for_jobs: self.drain_jobs()
+        after = self.counters.snapshot()
+        if scenario.teardown and not scenario.exclusive: scenario.teardown(self)
+        statuses = {}
+        for status, _ in results: statuses[status] = statuses.get(status, 0) + 1
+        spawns, connections = after[0] - before[0] - setup_cost[0], after[1] - before[1] - setup_cost[1]
+        return [latency for _, latency in results], statuses, spawns, connections, wall
+
+def summarize(scenario, latencies, statuses, spawns, connections, wall):
+    count = len(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "path": scenario.path, "method": scenario.method, "requests": count,
+        "status_codes": {str(code): n for code, n in sorted(statuses.items())},
+        "unexpected_status": sum(n for code, n in statuses.items() if code not in scenario.expect),
+        "p50_ms": ms(percentile(latencies, 0.50)), "p95_ms": ms(percentile(latencies, 0.95)), "p99_ms": ms(percentile(latencies, 0.99)),
+        "mean_ms": ms(sum(latencies) / count) if count else None, "max_ms": ms(max(latencies)) if count else None,
+        "rps": round(count / wall, 2) if wall else None,
+        "spawns_per_request": round(spawns / count, 3) if count else None,
+        "adb_connections_per_request": round(connections / count, 3) if count else None,
+    }
+
+def print_run(run):
+    print(f"\n== mode={run['mode']} transport={run['transport']} latency={run['latency']}s ==")
+    print(f"{'route':<28}{'n':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>10}{'spawn/req':>11}{'adb/req':>9}  status")
+    for name, result in run['routes'].items():
+        if 'error' in result:
+            print(f"{name:<28}  failed: {result['error']}")
+            continue
+        codes = ' '.join(f"{code}x{n}" for code, n in result['status_codes'].items())
+        flag = '  (unexpected)' if result['unexpected_status'] else ''
+        print(f"{name:<28}{result['requests']:>5}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{result['rps']:>10.1f}{result['spawns_per_request']:>11.2f}{result['adb_connections_per_request']:>9.2f}  {codes}{flag}")
+    if run['uncovered']: print(f"Routes without a scenario: {', '.join(run['uncovered'])}")
+
+def compare(previous_path, current, threshold):
+    with open(previous_path, encoding='utf-8') as f: previous = json.load(f)
+    old_runs = {(run['mode'], run['transport']): run for run in previous.get('runs', [])}
+    regressions = 0
+    for run in current['runs']:
+        old = old_runs.get((run['mode'], run['transport']))
+        if not old: continue
+        print(f"\n== compare mode={run['mode']} transport={run['transport']} against {previous_path} ==")
+        print(f"{'route':<28}{'p50 old':>10}{'p50 new':>10}{'Δ%':>8}{'p95 old':>10}{'p95 new':>10}{'Δ%':>8}")
+        for name, result in run['routes'].items():
+            before = old['routes'].get(name)
+            if not before or 'error' in result or 'error' in before: continue
+            deltas = [
+                (result[key] - before[key]) * 100 / before[key] if before[key] else 0.0 for key in ('p50_ms', 'p95_ms')
+            ]
+            regressed = any(delta > threshold for delta in deltas)
+            regressions += regressed
+            print(f"{name:<28}{before['p50_ms']:>10.2f}{result['p50_ms']:>10.2f}{deltas[0]:>+8.1f}"
+                  f"{before['p95_ms']:>10.2f}{result['p95_ms']:>10.2f}{deltas[1]:>+8.1f}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def git_revision():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.TimeoutExpired): return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every app.py route against a fake adb.")
+    parser.add_argument('--mode', choices=('client', 'http'), default='client', help="Flask test client, or real HTTP with --concurrency workers")
+    parser.add_argument('--transport', choices=('server', 'cli', 'both'), default='both', help="adb server socket, adb CLI subprocesses, or both")
+    parser.add_argument('--latency', type=float, default=0.005, help="seconds the fake device takes per adb command")
+    parser.add_argument('--requests', type=int, default=20, help="timed requests per route")
+    parser.add_argument('--warmup', type=int, default=2, help="untimed requests per route before measuring")
+    parser.add_argument('--concurrency', type=int, default=4, help="parallel clients in --mode http")
+    parser.add_argument('--routes', default='', help="comma-separated scenario names (default: all)")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help="JSON results file")
+    parser.add_argument('--compare', help="earlier results file to diff against")
+    parser.add_argument('--threshold', type=float, default=10.0, help="percent slowdown reported as a regression")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='nexus-bench-')
+    os.environ['NEXUS_BENCH_STATE'] = os.path.join(workdir, 'device')
+    os.environ['NEXUS_BENCH_LATENCY'] = str(options.latency)
+    os.makedirs(os.environ['NEXUS_BENCH_STATE'])
+    install_stubs(os.path.join(workdir, 'bin'))
+    os.environ['PATH'] = os.path.join(workdir, 'bin') + os.pathsep + os.environ['PATH']
+    server = FakeAdbServer(options.latency)
+    os.environ['ANDROID_ADB_SERVER_PORT'] = str(server.port)
+    scan_listener = socket.create_server(('127.0.0.1', 0))
+    threading.Thread(target=lambda: [scan_listener.accept()[0].close() for _ in iter(int, 1)], daemon=True).start()
+
+    # app.py creates its folders relative to the working directory on import.
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(workdir)
+    import app as app_module
+    app_module.BACKUP_BASE_DRIVE = workdir
+    counters = Counters()
+    counters.install(app_module)
+    bench = Bench(app_module, counters, workdir)
+
+    selected = scenarios(scan_listener.getsockname()[1])
+    if options.routes:
+        wanted = {name.strip() for name in options.routes.split(',') if name.strip()}
+        selected = [scenario for scenario in selected if scenario.name in wanted]
+    covered = {re.sub(r'\{(\w+)\}', r'<\1>', scenario.path.split('?')[0]) for scenario in scenarios(0)}
+    covered |= {path.replace('<name>', '<path:name>') for path in covered}
+    uncovered = sorted(rule.rule for rule in app_module.app.url_map.iter_rules() if rule.endpoint != 'static' and rule.rule not in covered)
+
+    http_port = None
+    if options.mode == 'http':
+        import logging
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        http_server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+        http_port = http_server.server_port
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    results = {
+        "meta": {
+            "created": time.strftime('%Y-%m-%dT%H:%M:%S'), "revision": git_revision(), "python": platform.python_version(),
+            "platform": platform.platform(), "requests": options.requests, "warmup": options.warmup,
+            "concurrency": options.concurrency if options.mode == 'http' else 1,
+        },
+        "runs": [],
+    }
+    for transport in (('server', 'cli') if options.transport == 'both' else (options.transport,)):
+        app_module.USE_ADB_SERVER = transport == 'server'
+        app_module.device_info_cache.invalidate('BENCH001')
+        app_module.package_catalog.invalidate('BENCH001')
+        run = {"mode": options.mode, "transport": transport, "latency": options.latency, "routes": {}, "uncovered": uncovered}
+        for scenario in selected:
+            try:
+                if options.mode == 'http': measured = bench.run_http(scenario, options.requests, options.warmup, options.concurrency, http_port)
+                else: measured = bench.run_client(scenario, options.requests, options.warmup)
+                run["routes"][scenario.name] = summarize(scenario, *measured)
+            except Exception as e:
+                run["routes"][scenario.name] = {"path": scenario.path, "error": f"{type(e).__name__}: {e}"}
+        results["runs"].append(run)
+        print_run(run)
+
+    output = os.path.join(REPO_ROOT, options.output) if not os.path.isabs(options.output) else options.output
+    with open(output, 'w', encoding='utf-8') as f: json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+    if options.compare:
+        compare_path = options.compare if os.path.isabs(options.compare) else os.path.join(REPO_ROOT, options.compare)
+        if compare(compare_path, results, options.threshold): sys.exit(1)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--fake-adb']: sys.exit(fake_adb_cli(sys.argv[2:]))
+    if sys.argv[1:2] == ['--fake-scrcpy']: sys.exit(fake_scrcpy_cli(sys.argv[2:]))
+    main()
@@ -0,0 +1,264 @@
+"""Content-defined chunking and a deduplicating, compressed chunk store for device backups.
+
+Kept apart from app.py so the functions the process-pool workers run do not depend on the Flask app
+or any device state. The workers still import app.py as __mp_main__ when they start (see backup_pool()
+there for the start method); they only ever call into this module.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+
+# --- Chunking ---
+# Every byte goes through WINDOW random tables and is XORed with its neighbours' (on big integers, so
+# it runs at C speed); a chunk may end wherever two consecutive mixed bytes are zero, which happens
+# about once per 64 KiB in any data with some variety. A cut depends only on the few bytes before it,
+# so an insertion or deletion changes just the chunks around it and the rest of the stream dedups.
+WINDOW = 4
+ANCHOR = b'\0\0'
+MIX_TABLES = [
+    bytes.maketrans(bytes(range(256)), bytes(hashlib.sha256(bytes([k, i])).digest()[0] for i in range(256))) for k in range(WINDOW)
+]
+
+def mix(data):
+    value = 0
+    for shift, table in enumerate(MIX_TABLES): value ^= int.from_bytes(data.translate(table), 'big') << (8 * shift)
+    # Entry j covers data[j:j + WINDOW].
+    return value.to_bytes(len(data) + WINDOW - 1, 'big')[WINDOW - 1:len(data)]
+
+def find_anchors(data, context=0):
+    # Pool worker: cut positions relative to data[context:], for anchors that end past the context.
+    mixed, found = mix(data), []
+    position = mixed.find(ANCHOR)
+    while position != -1:
+        cut = position + WINDOW + len(ANCHOR) - 1 - context
+        if cut > 0: found.append(cut)
+        position = mixed.find(ANCHOR, position + 1)
+    return found
+
+def compress_chunks(chunks, level):
+    # Pool worker.
+    return [zlib.compress(chunk, level) for chunk in chunks]
+
+class Chunker:
+    # Feed the stream in order and get finished chunks back in order. Segments are scanned for anchors
+    # in the pool (each with the WINDOW bytes before it as context, so the result matches a sequential
+    # scan); the min/max chunk sizes are applied here, in stream order.
+    def __init__(self, pool, min_size, max_size, segment_size, depth):
+        self.pool = pool
+        self.min_size = min_size
+        self.max_size = max_size
+        self.segment_size = segment_size
+        self.depth = depth
+        self._pending = bytearray() # not yet submitted for scanning
+        self._context = b''
+        self._submitted = 0
+        self._scans = deque() # (segment start, segment, future)
+        self._buffer = bytearray() # scanned but not yet emitted; starts at the last cut
+        self._last = 0
+
+    def feed(self, data):
+        self._pending += data
+        while len(self._pending) >= self.segment_size: self._submit(self.segment_size)
+        chunks = []
+        while self._scans and (self._scans[0][2].done() or len(self._scans) > self.depth): chunks += self._resolve()
+        return chunks
+
+    def finish(self):
+        if self._pending: self._submit(len(self._pending))
+        chunks = []
+        while self._scans: chunks += self._resolve()
+        if self._buffer: chunks.append(bytes(self._buffer))
+        self._last += len(self._buffer)
+        self._buffer.clear()
+        return chunks
+
+    def _submit(self, size):
+        segment = bytes(self._pending[:size])
+        del self._pending[:size]
+        self._scans.append((self._submitted, segment, self.pool.submit(find_anchors, self._context + segment, len(self._context))))
+        self._submitted += len(segment)
+        self._context = segment[-WINDOW:]
+
+    def _resolve(self):
+        start, segment, future = self._scans.popleft()
+        self._buffer += segment
+        cuts, last = [], self._last
+        for anchor in future.result():
+            position = start + anchor
+            while position - last > self.max_size:
+                last += self.max_size
+                cuts.append(last)
+            if position - last >= self.min_size:
+                last = position
+                cuts.append(last)
+        while start + len(segment) - last > self.max_size:
+            last += self.max_size
+            cuts.append(last)
+        chunks, previous = [], self._last
+        for cut in cuts:
+            chunks.append(bytes(self._buffer[previous - self._last:cut - self._last]))
+            previous = cut
+        del self._buffer[:last - self._last]
+        self._last = last
+        return chunks
+
+# --- Store ---
+class ChunkStoreError(Exception):
+    pass
+
+class ChunkStore:
+    # chunks/<ab>/<sha256> holds one zlib-compressed chunk named by the hash of its plain bytes, and
+    # manifests/<id>.json lists a backup's chunks in order. Chunks are added by running backups and
+    # removed only by sweep(), which holds the lock so it never races a backup deciding to reuse one.
+    def __init__(self, root):
+        self.root = root
+        self.chunks_dir = os.path.join(root, 'chunks')
+        self.manifests_dir = os.path.join(root, 'manifests')
+        os.makedirs(self.chunks_dir, exist_ok=True)
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        self._active = {} # writer -> digests it references
+        self._lock = threading.Lock()
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def claim(self, writer, digest):
+        # Records that `writer` uses the chunk; returns True when it is already stored.
+        with self._lock:
+            self._active.setdefault(writer, set()).add(digest)
+            return os.path.exists(self.chunk_path(digest))
+
+    def release(self, writer):
+        with self._lock: self._active.pop(writer, None)
+
+    def put(self, digest, compressed):
+        path = self.chunk_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(temp, 'wb') as f: f.write(compressed)
+        os.replace(temp, path)
+
+    def get(self, digest):
+        try:
+            with open(self.chunk_path(digest), 'rb') as f: data = zlib.decompress(f.read())
+        except (OSError, zlib.error) as e: raise ChunkStoreError(f"Chunk {digest[:12]} is missing or unreadable: {e}")
+        if hashlib.sha256(data).hexdigest() != digest: raise ChunkStoreError(f"Chunk {digest[:12]} is corrupt.")
+        return data
+
+    def manifest_path(self, backup_id):
+        return os.path.join(self.manifests_dir, f"{os.path.basename(backup_id)}.json")
+
+    def save_manifest(self, manifest):
+        path = self.manifest_path(manifest["id"])
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f: json.dump(manifest, f)
+        os.replace(f"{path}.tmp", path)
+
+    def load_manifest(self, backup_id):
+        try:
+            with open(self.manifest_path(backup_id), encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError): return None
+
+    def manifests(self):
+        # Summaries, newest first, without the chunk lists.
+        summaries = []
+        for name in os.listdir(self.manifests_dir):
+            if not name.endswith('.json'): continue
+            manifest = self.load_manifest(name[:-5])
+            if manifest: summaries.append({key: value for key, value in manifest.items() if key != 'chunks'})
+        return sorted(summaries, key=lambda manifest: manifest["created"], reverse=True)
+
+    def delete(self, backup_id):
+        try: os.remove(self.manifest_path(backup_id))
+        except FileNotFoundError: return False
+        return True
+
+    def sweep(self):
+        # Removes chunks no manifest or running backup refers to; returns (chunks, bytes) freed.
+        with self._lock:
+            referenced = set().union(*self._active.values()) if self._active else set()
+            for name in os.listdir(self.manifests_dir):
+                if name.endswith('.json'): referenced.update((self.load_manifest(name[:-5]) or {}).get("chunks", ()))
+            freed = freed_bytes = 0
+            for folder in os.listdir(self.chunks_dir):
+                for name in os.listdir(os.path.join(self.chunks_dir, folder)):
+                    if name in referenced: continue
+                    path = os.path.join(self.chunks_dir, folder, name)
+                    freed_bytes += os.path.getsize(path)
+                    os.remove(path)
+                    freed += 1
+        return freed, freed_bytes
+
+    def stats(self):
+        chunks = stored = 0
+        for folder in os.listdir(self.chunks_dir):
+            with os.scandir(os.path.join(self.chunks_dir, folder)) as entries:
+                for entry in entries:
+                    chunks += 1
+                    stored += entry.stat().st_size
+        return {"chunks": chunks, "stored_bytes": stored}
+
+class ChunkWriter:
+    # Stores one backup's chunks. New ones are compressed in the pool in batches while the stream keeps
+    # flowing; a chunk the store (or this backup) already has costs only its hash.
+    def __init__(self, store, pool, level, batch_bytes, depth):
+        self.store = store
+        self.pool = pool
+        self.level = level
+        self.batch_bytes = batch_bytes
+        self.depth = depth
+        self.digests = []
+        self.new_chunks = self.new_bytes = 0
+        self._seen = set()
+        self._batch, self._batch_size = [], 0
+        self._compressing = deque() # (digests, future)
+
+    def add(self, chunk):
+        digest = hashlib.sha256(chunk).hexdigest()
+        self.digests.append(digest)
+        if digest in self._seen: return
+        self._seen.add(digest)
+        if self.store.claim(self, digest): return
+        self._batch.append((digest, chunk))
+        self._batch_size += len(chunk)
+        if self._batch_size >= self.batch_bytes: self._flush()
+
+    def _flush(self):
+        if self._batch:
+            digests, chunks = zip(*self._batch)
+            self._compressing.append((digests, self.pool.submit(compress_chunks, list(chunks), self.level)))
+            self._batch, self._batch_size = [], 0
+        while self._compressing and (self._compressing[0][1].done() or len(self._compressing) > self.depth): self._write()
+
+    def _write(self):
+        digests, future = self._compressing.popleft()
+        for digest, compressed in zip(digests, future.result()):
+            self.store.put(digest, compressed)
+            self.new_chunks += 1
+            self.new_bytes += len(compressed)
+
+    def close(self):
+        self._flush()
+        while self._compressing: self._write()
+
+    def abort(self):
+        for _, future in self._compressing: future.cancel()
+        self._compressing.clear()
+        self.store.release(self)
+
+def new_backup_id(device_id):
+    return f"{time.strftime('%Y-%m-%d_%H%M%S')}_{''.join(c if c.isalnum() else '_' for c in device_id)}_{uuid.uuid4().hex[:4]}"
+
+def restore_stream(store, manifest, level):
+    # Rebuilds the .ab: the original header, then the payload, re-deflated if it was inflated for storage.
+    yield manifest["header"].encode('utf-8')
+    compressor = zlib.compressobj(level) if manifest["inflated"] else None
+    for digest in manifest["chunks"]:
+        data = store.get(digest)
+        if compressor: data = compressor.compress(data)
+        if data: yield data
+    if compressor: yield compressor.flush()